@@ -55,7 +55,282 @@ def search(lines,pattern,history=5):
         if pattern in line:
             yield line,previous_lines
         previous_lines.append(line)
-        
+
+
+'''
+search() yields the live deque, so the history changes under the caller and has to be
+copied for every hit. For huge files and many patterns at once, memory-map the file and
+scan it a single time:
+    PatternSet: Aho-Corasick automaton, finds all (overlapping) occurrences in one pass.
+    prefilter:  the same trie written as one regex, so lines without any hit are skipped
+                by the C regex engine instead of a Python loop.
+    For a handful of patterns one bytes.find() cursor per pattern is faster still, so
+    PatternSet.scan() switches strategy on the number of patterns.
+Context lines are sliced straight out of the mmap, so close hits share no state and
+nothing is rescanned.
+'''
+
+import heapq
+import mmap
+import os
+import re
+
+class PatternSet(object):
+    '''Aho-Corasick automaton over a set of byte patterns'''
+    few = 16     # up to this many patterns, scan() uses bytes.find() cursors
+
+    def __init__(self,patterns):
+        self.patterns = [p.encode() if isinstance(p,str) else bytes(p) for p in patterns]
+        if not self.patterns or not all(self.patterns):
+            raise ValueError('patterns must be non-empty')
+        if any(b'\n' in p for p in self.patterns):
+            raise ValueError('patterns cannot contain a newline')
+        self.goto = [{}]     # trie: state -> {byte: next state}
+        self.fail = [0]
+        self.out = [[]]      # patterns ending at each state
+        for p in self.patterns:
+            state = 0
+            for ch in p:
+                nxt = self.goto[state].get(ch)
+                if nxt is None:
+                    nxt = len(self.goto)
+                    self.goto[state][ch] = nxt
+                    self.goto.append({})
+                    self.fail.append(0)
+                    self.out.append([])
+                state = nxt
+            if p not in self.out[state]:
+                self.out[state].append(p)
+        self.terminal = {s for s,o in enumerate(self.out) if o}
+
+        # Breadth first: the fail link of a state is the longest proper suffix in the trie
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for ch,nxt in self.goto[state].items():
+                queue.append(nxt)
+                f = self.fail[state]
+                while f and ch not in self.goto[f]:
+                    f = self.fail[f]
+                self.fail[nxt] = self.goto[f].get(ch,0)
+                self.out[nxt] = self.out[nxt] + self.out[self.fail[nxt]]
+
+        self.prefilter = re.compile(self._trie_regex(0))
+
+    def _trie_regex(self,state):
+        # The shortest pattern is enough to flag a line, so stop at terminal states.
+        if state in self.terminal:
+            return b''
+        branches = [re.escape(bytes([ch])) + self._trie_regex(nxt)
+                    for ch,nxt in sorted(self.goto[state].items())]
+        if len(branches) == 1:
+            return branches[0]
+        return b'(?:' + b'|'.join(branches) + b')'
+
+    def findall(self,text):
+        '''Return [(start,pattern),...] for every occurrence, overlaps included'''
+        goto,fail,out = self.goto,self.fail,self.out
+        state = 0
+        hits = []
+        for i,ch in enumerate(text):
+            while state and ch not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(ch,0)
+            for p in out[state]:
+                hits.append((i-len(p)+1,p))
+        return hits
+
+    def scan(self,buf):
+        '''Yield (start,end,hits) for each line of buf with at least one occurrence'''
+        size = len(buf)
+        if len(self.patterns) <= self.few:
+            # One cursor per pattern, ordered by the position of its next occurrence
+            cursors = [(buf.find(p),p) for p in set(self.patterns)]
+            cursors = [c for c in cursors if c[0] >= 0]
+            heapq.heapify(cursors)
+            while cursors:
+                start = buf.rfind(b'\n',0,cursors[0][0]) + 1
+                end = buf.find(b'\n',cursors[0][0])
+                if end < 0:
+                    end = size
+                hits = []
+                while cursors and cursors[0][0] < end:
+                    pos,p = cursors[0]
+                    hits.append((pos-start,p))
+                    pos = buf.find(p,pos+1)
+                    if pos < 0:
+                        heapq.heappop(cursors)
+                    else:
+                        heapq.heapreplace(cursors,(pos,p))
+                yield start,end,hits
+        else:
+            pos = 0
+            while pos < size:
+                m = self.prefilter.search(buf,pos)
+                if m is None:
+                    break
+                start = buf.rfind(b'\n',0,m.start()) + 1
+                end = buf.find(b'\n',m.end())
+                if end < 0:
+                    end = size
+                yield start,end,self.findall(buf[start:end])
+                pos = end + 1
+
+
+def _count_newlines(mm,start,stop,chunk=1<<24):
+    n = 0
+    while start < stop:
+        n += mm[start:min(start+chunk,stop)].count(b'\n')
+        start += chunk
+    return n
+
+def _lines_before(mm,start,n):
+    lines = []
+    while n > 0 and start > 0:
+        prev = mm.rfind(b'\n',0,start-1) + 1
+        lines.append(mm[prev:start-1])
+        start = prev
+        n -= 1
+    return tuple(reversed(lines))
+
+def _lines_after(mm,end,n):
+    lines = []
+    size = len(mm)
+    while n > 0 and end+1 < size:
+        nxt = mm.find(b'\n',end+1)
+        if nxt < 0:
+            nxt = size
+        lines.append(mm[end+1:nxt])
+        end = nxt
+        n -= 1
+    return tuple(lines)
+
+def msearch(filename,patterns,before=5,after=0):
+    '''
+    Multi-pattern search() over a memory-mapped file.
+    Yields (lineno, line, hits, before_lines, after_lines); hits is [(column,pattern),...]
+    and the context windows are tuples of bytes (without newlines).
+    '''
+    pset = patterns if isinstance(patterns,PatternSet) else PatternSet(patterns)
+    if os.path.getsize(filename) == 0:
+        return
+    with open(filename,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        lineno,counted = 1,0
+        for start,end,hits in pset.scan(mm):
+            lineno += _count_newlines(mm,counted,start)
+            counted = start
+            yield (lineno,mm[start:end],hits,
+                   _lines_before(mm,start,before),_lines_after(mm,end,after))
+
+'''
+for lineno,line,hits,prev,nxt in msearch('somefile',['python','error']):
+    print(lineno,line,hits)
+'''
+
+def bench_msearch(nlines=200000,counts=(1,10,500)):
+    '''Time msearch() against the per-line "in" loop of search()'''
+    import random
+    import tempfile
+    import time
+    rnd = random.Random(0)
+    word = lambda: ''.join(rnd.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(8))
+    words = [word() for _ in range(5000)]
+    needles = [word().upper() for _ in range(max(counts))]
+    with tempfile.NamedTemporaryFile('w',suffix='.log',delete=False) as f:
+        for _ in range(nlines):
+            line = [rnd.choice(words) for _ in range(10)]
+            if rnd.random() < 0.01:          # about 1% of the lines are hits
+                line[rnd.randrange(10)] = rnd.choice(needles)
+            f.write(' '.join(line) + '\n')
+        filename = f.name
+    try:
+        for n in counts:
+            patterns = needles[:n]
+            t0 = time.perf_counter()
+            with open(filename) as f:
+                previous_lines = deque(maxlen=5)
+                for line in f:
+                    for p in patterns:
+                        if p in line:
+                            hit = (line,list(previous_lines))
+                            break
+                    previous_lines.append(line)
+            t1 = time.perf_counter()
+            for hit in msearch(filename,patterns):
+                pass
+            t2 = time.perf_counter()
+            print('{:4d} patterns: in-loop {:.3f}s  msearch {:.3f}s'.format(n,t1-t0,t2-t1))
+    finally:
+        os.remove(filename)
+
+
+'''
+Many files, or one very large file: cut every file into line-aligned byte ranges and
+search the shards in a process pool. Each worker maps the whole file, so the context
+windows can reach across shard boundaries. Line numbers are counted per shard and
+offset in the parent; executor.map() returns the shards in order, so the results
+still stream in file/line order.
+'''
+
+from concurrent.futures import ProcessPoolExecutor
+
+def _shards(filenames,shard_size):
+    for filename in filenames:
+        size = os.path.getsize(filename)
+        if size == 0:
+            continue
+        with open(filename,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < size:
+                stop = mm.find(b'\n',min(start+shard_size,size)-1)
+                stop = size if stop < 0 else stop+1
+                yield filename,start,stop
+                start = stop
+
+_worker_patterns = None
+
+def _init_worker(patterns):
+    global _worker_patterns
+    _worker_patterns = patterns
+
+def _search_shard(shard,before,after):
+    filename,start,stop = shard
+    with open(filename,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        buf = mm[start:stop]
+        results = []
+        lineno,counted = 1,0
+        for s,e,hits in _worker_patterns.scan(buf):
+            lineno += buf.count(b'\n',counted,s)
+            counted = s
+            results.append((lineno,buf[s:e],hits,
+                            _lines_before(mm,start+s,before),_lines_after(mm,start+e,after)))
+        return buf.count(b'\n'),results
+
+def psearch(filenames,patterns,before=5,after=0,workers=None,shard_size=1<<26):
+    '''
+    Parallel msearch() over many files.
+    Yields (filename, lineno, line, hits, before_lines, after_lines) in file/line order.
+    '''
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    pset = patterns if isinstance(patterns,PatternSet) else PatternSet(patterns)
+    shards = list(_shards(filenames,shard_size))
+    with ProcessPoolExecutor(workers,initializer=_init_worker,initargs=(pset,)) as pool:
+        results = pool.map(_search_shard,shards,[before]*len(shards),[after]*len(shards))
+        current,base = None,0
+        for (filename,start,stop),(nlines,hits) in zip(shards,results):
+            if filename != current:
+                current,base = filename,0
+            for lineno,line,found,prev,nxt in hits:
+                yield filename,base+lineno,line,found,prev,nxt
+            base += nlines
+
+'''
+if __name__ == '__main__':
+    import glob
+    for filename,lineno,line,hits,prev,nxt in psearch(glob.glob('logs/*.log'),['ERROR']):
+        print(filename,lineno,line)
+'''
 
 
 
@@ -76,6 +351,188 @@ heapq.heappop(nums)          # pop the first element and returns it
 heapq.heapify(nums)
 '''
 
+'''
+nlargest() needs the whole collection. For a stream that never fits in memory keep a
+heap of at most k items whose root is the worst item kept: a new item only enters when
+it beats the root. Memory is O(k) and partial results from workers merge by offering
+one heap to another. NumPy arrays are fed in bulk: argpartition() finds the k-th best
+key of a batch, only the rows at least that good are sorted, and only the k best of
+them reach the Python heap.
+Ties keep the earliest item, like nlargest()/nsmallest().
+'''
+
+import numpy as np
+
+class _Reversed(object):
+    '''Inverts the ordering of a key so a min-heap keeps the k smallest'''
+    __slots__ = ('value',)
+    def __init__(self,value):
+        self.value = value
+
+    def __lt__(self,other):
+        return other.value < self.value
+
+    def __eq__(self,other):
+        return self.value == other.value
+
+
+class TopK(object):
+    '''Bounded accumulator for the k largest (or smallest) items of a stream'''
+    def __init__(self,k,key=None,largest=True):
+        if k < 0:
+            raise ValueError('k must be >= 0')
+        self.k = k
+        self.key = key
+        self.largest = largest
+        self.heap = []       # (sortkey, -arrival, item), root is the worst item kept
+        self.count = 0
+        self.pending = []    # array batches as (keys, arrival, values), at most ~2k rows
+        self.npending = 0
+        self.cutoff = None   # k-th best key among the pending rows
+
+    def __len__(self):
+        self._flush()
+        return len(self.heap)
+
+    def _offer(self,sortkey,item):
+        entry = (sortkey,-self.count,item)
+        self.count += 1
+        if len(self.heap) < self.k:
+            heapq.heappush(self.heap,entry)
+        elif self.heap and self.heap[0][0] < sortkey:
+            heapq.heapreplace(self.heap,entry)
+
+    def push(self,item):
+        value = item if self.key is None else self.key(item)
+        self._offer(value if self.largest else _Reversed(value),item)
+
+    def extend(self,items):
+        '''Feed an iterable, or a NumPy array in one vectorised step'''
+        if isinstance(items,np.ndarray):
+            return self._extend_array(items)
+        heap,k,key,largest = self.heap,self.k,self.key,self.largest
+        push,replace = heapq.heappush,heapq.heapreplace
+        count = self.count
+        for item in items:
+            value = item if key is None else key(item)
+            sortkey = value if largest else _Reversed(value)
+            if len(heap) < k:
+                push(heap,(sortkey,-count,item))
+            elif heap and heap[0][0] < sortkey:
+                replace(heap,(sortkey,-count,item))
+            count += 1
+        self.count = count
+
+    def _extend_array(self,values):
+        '''key, if given, must be vectorised: key(array) -> array of keys'''
+        keys = values if self.key is None else np.asarray(self.key(values))
+        arrival = np.arange(self.count,self.count+len(keys))
+        self.count += len(keys)
+        if self.k == 0:
+            return
+        # Anything not better than k items we already hold can never make it
+        cutoffs = [self.cutoff] if self.cutoff is not None else []
+        if len(self.heap) == self.k:
+            root = self.heap[0][0]
+            cutoffs.append(root if self.largest else root.value)
+        if cutoffs:
+            if self.largest:
+                mask = keys > max(cutoffs)
+            else:
+                mask = keys < min(cutoffs)
+            keys,arrival,values = keys[mask],arrival[mask],values[mask]
+        self.pending.append((keys,arrival,values))
+        self.npending += len(keys)
+        if self.npending > 2*self.k:
+            self._compact()
+
+    def _compact(self):
+        keys,arrival,values = (np.concatenate(col) for col in zip(*self.pending))
+        if len(keys) > self.k:
+            # argpartition() finds the k-th best key in O(n); only the rows at least
+            # that good (ties included) are sorted below
+            if self.largest:
+                kth = keys[np.argpartition(keys,len(keys)-self.k)[len(keys)-self.k]]
+                mask = keys >= kth
+            else:
+                kth = keys[np.argpartition(keys,self.k-1)[self.k-1]]
+                mask = keys <= kth
+            if mask.sum() >= self.k:            # not so when kth is NaN
+                keys,arrival,values = keys[mask],arrival[mask],values[mask]
+        # Best key first, earliest arrival first among equal keys
+        if self.largest:
+            order = np.lexsort((-arrival,keys))[::-1][:self.k]
+        else:
+            order = np.lexsort((arrival,keys))[:self.k]
+        self.pending = [(keys[order],arrival[order],values[order])]
+        self.npending = len(order)
+        if len(order) == self.k:
+            self.cutoff = keys[order[-1]]
+
+    def _flush(self):
+        '''Move the pending array rows into the heap'''
+        if not self.pending:
+            return
+        self._compact()
+        keys,arrival,values = self.pending[0]
+        wrap = (lambda v: v) if self.largest else _Reversed
+        self.heap.extend((wrap(key),-i,item) for key,i,item in
+                         zip(keys.tolist(),arrival.tolist(),values.tolist()))
+        if len(self.heap) > self.k:
+            self.heap.sort(reverse=True)
+            del self.heap[self.k:]
+        heapq.heapify(self.heap)
+        self.pending,self.npending,self.cutoff = [],0,None
+
+    def merge(self,*others):
+        '''Fold in the partial results of other accumulators (e.g. from workers)'''
+        self._flush()
+        for other in others:
+            if other.largest != self.largest:
+                raise ValueError('cannot merge largest and smallest accumulators')
+            other._flush()
+            for sortkey,_,item in sorted(other.heap,reverse=True):
+                self._offer(sortkey,item)
+        return self
+
+    def result(self):
+        '''The kept items, best first'''
+        self._flush()
+        return [item for _,_,item in sorted(self.heap,reverse=True)]
+
+
+top = TopK(3)
+top.extend(nums)
+top.result()                      # same as heapq.nlargest(3, nums)
+
+bottom = TopK(3,largest=False)
+bottom.extend(np.array(nums))
+bottom.result()                   # same as heapq.nsmallest(3, nums)
+
+
+def bench_topk(n=10**6,ks=(10,10**3,10**5),chunk=1<<16):
+    '''Time heapq.nlargest against TopK fed in chunks, from lists and from arrays'''
+    import random
+    import time
+    nums = [random.random() for _ in range(n)]
+    arr = np.array(nums)
+    for k in ks:
+        t0 = time.perf_counter()
+        heapq.nlargest(k,nums)
+        t1 = time.perf_counter()
+        top = TopK(k)
+        for i in range(0,n,chunk):
+            top.extend(nums[i:i+chunk])
+        top.result()
+        t2 = time.perf_counter()
+        top = TopK(k)
+        for i in range(0,n,chunk):
+            top.extend(arr[i:i+chunk])
+        top.result()
+        t3 = time.perf_counter()
+        print('k={:<7d} nlargest {:.3f}s  TopK list {:.3f}s  TopK array {:.3f}s'.format(
+              k,t1-t0,t2-t1,t3-t2))
+
 
 
 # 1.5 Implementing a priority queue
@@ -85,23 +542,87 @@ the item with the highest priority on each pop operation.
 '''
 
 class PriorityQueue(object):
-    '''Represents a queue with the highest priority in the first element'''
+    '''
+    Represents a queue with the highest priority in the first element.
+    push() returns a handle for update_priority() and remove(). Both use lazy deletion:
+    the old heap entry is only marked as removed and skipped when it reaches the top,
+    so every operation stays O(log n).
+    '''
+    _REMOVED = object()
+
     def __init__(self):
         self.queue = []
         self.index = 0
-        
-    def __str__(self):
-        q = []
-        for item in self.queue:
-            q.append(str(item))
-        return '\n'.join(q)
-        
-    def push(self,priority,item):
-        heapq.heappush(self.queue,(-priority,self.index,item))
+        self.entries = {}    # handle -> live entry [-priority, index, item, handle]
+
+    def __repr__(self):
+        if not self.entries:
+            return '<PriorityQueue: empty>'
+        self._prune()
+        priority,_,item,_ = self.queue[0]
+        return '<PriorityQueue: {} items, next {!r} (priority {!r})>'.format(
+               len(self.entries),item,-priority)
+
+    def __len__(self):
+        return len(self.entries)
+
+    def _entry(self,priority,item,handle=None):
+        entry = [-priority,self.index,item,self.index if handle is None else handle]
         self.index += 1
-        
+        self.entries[entry[3]] = entry
+        return entry
+
+    def _prune(self):
+        while self.queue and self.queue[0][2] is self._REMOVED:
+            heapq.heappop(self.queue)
+
+    def _discard(self,handle):
+        entry = self.entries.pop(handle)
+        item,entry[2] = entry[2],self._REMOVED
+        # Rebuild once dead entries outnumber live ones, so memory stays O(n)
+        if len(self.queue) > 2*len(self.entries) + 64:
+            self.queue = [e for e in self.queue if e[2] is not self._REMOVED]
+            heapq.heapify(self.queue)
+        return item
+
+    def push(self,priority,item):
+        entry = self._entry(priority,item)
+        heapq.heappush(self.queue,entry)
+        return entry[3]
+
+    def push_many(self,pairs):
+        '''Push (priority, item) pairs; a large batch is heapified in one pass'''
+        new = [self._entry(priority,item) for priority,item in pairs]
+        if len(new) > len(self.queue):
+            self.queue.extend(new)
+            heapq.heapify(self.queue)
+        else:
+            for entry in new:
+                heapq.heappush(self.queue,entry)
+        return [entry[3] for entry in new]
+
     def pop(self):
-        return heapq.heappop(self.queue)[2]
+        self._prune()
+        if not self.queue:
+            raise IndexError('pop from an empty priority queue')
+        entry = heapq.heappop(self.queue)
+        del self.entries[entry[3]]
+        return entry[2]
+
+    def peek(self):
+        self._prune()
+        if not self.queue:
+            raise IndexError('peek from an empty priority queue')
+        return self.queue[0][2]
+
+    def remove(self,handle):
+        '''Cancel a pushed item, returns it; KeyError if it is already gone'''
+        return self._discard(handle)
+
+    def update_priority(self,handle,priority):
+        '''Move an item to a new priority; it queues behind items already at that priority'''
+        item = self._discard(handle)
+        heapq.heappush(self.queue,self._entry(priority,item,handle))
     
     
 q = PriorityQueue()
@@ -111,6 +632,361 @@ q.push(5,'peach')
 q.push(1,'orange')
 q.pop()
 
+# Handles: cancel or reprioritise a queued item
+q = PriorityQueue()
+q.push(4,'pear')
+h = q.push(5,'peach')
+q.update_priority(h,0)
+q.pop()                 # 'pear'
+q.push_many([(3,'plum'),(2,'kiwi')])
+q.remove(h)             # 'peach'
+
+'''
+Feeding the queue from several threads or from an event loop: keep the same
+(-priority, index, item) ordering and add the waiting.
+    BlockingPriorityQueue: every method runs under one Condition, pop() blocks until an
+                           item arrives or the timeout runs out (raises queue.Empty).
+    AsyncPriorityQueue:    pop() is a coroutine; waiting consumers park on futures the
+                           way asyncio.Queue does. Threads push with push_threadsafe().
+'''
+
+import asyncio
+import queue
+import threading
+
+class BlockingPriorityQueue(PriorityQueue):
+    '''Thread-safe PriorityQueue with a blocking pop()'''
+    def __init__(self):
+        super().__init__()
+        self.not_empty = threading.Condition()
+
+    def __repr__(self):
+        with self.not_empty:
+            return super().__repr__()
+
+    def __len__(self):
+        with self.not_empty:
+            return len(self.entries)
+
+    def push(self,priority,item):
+        with self.not_empty:
+            handle = super().push(priority,item)
+            self.not_empty.notify()
+            return handle
+
+    def push_many(self,pairs):
+        with self.not_empty:
+            handles = super().push_many(pairs)
+            self.not_empty.notify(len(handles))
+            return handles
+
+    def pop(self,block=True,timeout=None):
+        with self.not_empty:
+            if not self.entries:
+                if not block or not self.not_empty.wait_for(lambda: self.entries,timeout):
+                    raise queue.Empty
+            return super().pop()
+
+    def peek(self):
+        with self.not_empty:
+            return super().peek()
+
+    def remove(self,handle):
+        with self.not_empty:
+            return super().remove(handle)
+
+    def update_priority(self,handle,priority):
+        with self.not_empty:
+            super().update_priority(handle,priority)
+
+
+class AsyncPriorityQueue(PriorityQueue):
+    '''PriorityQueue with an awaitable pop(), for use inside one event loop'''
+    def __init__(self,loop=None):
+        super().__init__()
+        self.loop = loop
+        self.getters = deque()
+
+    def _wakeup_next(self):
+        while self.getters:
+            getter = self.getters.popleft()
+            if not getter.done():
+                getter.set_result(None)
+                break
+
+    def push(self,priority,item):
+        handle = super().push(priority,item)
+        self._wakeup_next()
+        return handle
+
+    def push_many(self,pairs):
+        handles = super().push_many(pairs)
+        for _ in handles:
+            self._wakeup_next()
+        return handles
+
+    def push_threadsafe(self,priority,item):
+        '''Push from another thread; the item lands on the loop's next iteration'''
+        if self.loop is None:
+            raise RuntimeError('no event loop: pass loop= or await pop() first')
+        self.loop.call_soon_threadsafe(self.push,priority,item)
+
+    async def pop(self):
+        if self.loop is None:
+            self.loop = asyncio.get_running_loop()
+        while not self.entries:
+            getter = self.loop.create_future()
+            self.getters.append(getter)
+            try:
+                await getter
+            except BaseException:
+                getter.cancel()
+                try:
+                    self.getters.remove(getter)     # else idle timeouts pile up
+                except ValueError:
+                    pass                            # already popped by _wakeup_next()
+                if self.entries and not getter.cancelled():
+                    self._wakeup_next()     # pass our wakeup on to the next consumer
+                raise
+        return super().pop()
+
+    def pop_nowait(self):
+        return super().pop()
+
+'''
+async def consumer(q):
+    while True:
+        item = await asyncio.wait_for(q.pop(),timeout=1.0)
+'''
+
+
+def bench_pq_contention(n=200000,producers=(1,8,64)):
+    '''
+    n items from p producer threads to one consumer: a global lock + polling against
+    BlockingPriorityQueue, then asyncio.PriorityQueue against AsyncPriorityQueue
+    '''
+    import time
+
+    def run(push,pop,p):
+        def produce(k):
+            for i in range(k,n,p):
+                push(i % 10,i)
+        threads = [threading.Thread(target=produce,args=(k,)) for k in range(p)]
+        t0 = time.perf_counter()
+        for t in threads:
+            t.start()
+        for _ in range(n):
+            pop()
+        for t in threads:
+            t.join()
+        return time.perf_counter() - t0
+
+    def run_async(make,p):
+        # make(loop) -> (push from any thread, awaitable pop); one coroutine consumes
+        async def consume():
+            push,pop = make(asyncio.get_running_loop())
+            def produce(k):
+                for i in range(k,n,p):
+                    push(i % 10,i)
+            threads = [threading.Thread(target=produce,args=(k,)) for k in range(p)]
+            t0 = time.perf_counter()
+            for t in threads:
+                t.start()
+            for _ in range(n):
+                await pop()
+            for t in threads:
+                t.join()
+            return time.perf_counter() - t0
+        return asyncio.run(consume())
+
+    def asyncio_queue(loop):
+        q = asyncio.PriorityQueue()
+        return (lambda priority,item: loop.call_soon_threadsafe(q.put_nowait,(priority,item)),
+                q.get)
+
+    def async_queue(loop):
+        q = AsyncPriorityQueue(loop)
+        return q.push_threadsafe,q.pop
+
+    for p in producers:
+        # What we did before: one big lock around a plain PriorityQueue, busy-polling pop
+        plain,lock = PriorityQueue(),threading.Lock()
+        def locked_push(priority,item):
+            with lock:
+                plain.push(priority,item)
+        def polling_pop():
+            while True:
+                with lock:
+                    if len(plain):
+                        return plain.pop()
+                time.sleep(0)
+        t_poll = run(locked_push,polling_pop,p)
+        bq = BlockingPriorityQueue()
+        t_block = run(bq.push,bq.pop,p)
+        t_asyncio = run_async(asyncio_queue,p)
+        t_async = run_async(async_queue,p)
+        print('{:3d} producers: lock+poll {:.3f}s  BlockingPriorityQueue {:.3f}s  '
+              'asyncio.PriorityQueue {:.3f}s  AsyncPriorityQueue {:.3f}s'.format(
+              p,t_poll,t_block,t_asyncio,t_async))
+
+
+'''
+Timers: priority is the due time, most timers get cancelled before they fire, and
+all that is due should come out at once. A hierarchical timer wheel does push and
+cancel in O(1): level 0 has one bucket per tick, each higher level has buckets
+`slots` times wider, and a bucket is cascaded down a level when the clock enters it.
+Handles work like PriorityQueue's.
+'''
+
+import time
+
+class TimerWheel(object):
+    '''Hierarchical timer wheel; push(due,item) -> handle, pop(now) -> items due'''
+    def __init__(self,resolution=0.001,slots=256,levels=4,clock=time.monotonic):
+        if slots & (slots-1):
+            raise ValueError('slots must be a power of two')
+        self.resolution = resolution
+        self.bits = slots.bit_length() - 1
+        self.mask = slots - 1
+        self.levels = levels
+        self.clock = clock
+        self.wheel = [[{} for _ in range(slots)] for _ in range(levels)]
+        self.overflow = {}       # beyond the top level, placed again later
+        self.expired = {}        # pushed already overdue, drained by the next pop()
+        self.where = {}          # handle -> bucket {handle: (tick, item)}
+        self.current = self._tick(clock())   # next tick to expire
+        self.index = 0
+
+    def __len__(self):
+        return len(self.where)
+
+    def __repr__(self):
+        return '<TimerWheel: {} timers>'.format(len(self.where))
+
+    def _tick(self,t):
+        return int(t // self.resolution)
+
+    def _place(self,handle,tick,item):
+        delta = tick - self.current
+        level = (delta.bit_length()-1) // self.bits if delta > 0 else 0
+        if delta < 0:
+            bucket = self.expired
+        elif level < self.levels:
+            bucket = self.wheel[level][(tick >> (self.bits*level)) & self.mask]
+        else:
+            bucket = self.overflow
+        bucket[handle] = (tick,item)
+        self.where[handle] = bucket
+
+    def push(self,due,item):
+        handle = self.index
+        self.index += 1
+        self._place(handle,self._tick(due),item)
+        return handle
+
+    def remove(self,handle):
+        '''Cancel a timer in O(1), returns its item'''
+        return self.where.pop(handle).pop(handle)[1]
+
+    def update_priority(self,handle,due):
+        '''Move a timer to a new due time'''
+        item = self.remove(handle)
+        self._place(handle,self._tick(due),item)
+
+    def _cascade(self,bucket):
+        entries = list(bucket.items())
+        bucket.clear()
+        for handle,(tick,item) in entries:
+            self._place(handle,tick,item)
+
+    def pop(self,now=None):
+        '''Return every item due at or before now, in due order'''
+        target = self._tick(self.clock() if now is None else now)
+        due = []
+        if self.expired:
+            # overdue when pushed: they all come before anything left on the wheel
+            for handle,(tick,item) in sorted(self.expired.items(),key=lambda e: (e[1][0],e[0])):
+                due.append(item)
+                del self.where[handle]
+            self.expired.clear()
+        while self.current <= target:
+            if not self.where:
+                self.current = target + 1      # nothing to expire, jump ahead
+                break
+            # Entering a new block of a level: cascade its bucket one level down
+            level = 0
+            while level+1 < self.levels and (self.current >> (self.bits*level)) & self.mask == 0:
+                level += 1
+            if level == self.levels - 1 and self.overflow:
+                self._cascade(self.overflow)
+            for l in range(level,0,-1):
+                self._cascade(self.wheel[l][(self.current >> (self.bits*l)) & self.mask])
+            bucket = self.wheel[0][self.current & self.mask]
+            if bucket:
+                for handle in sorted(bucket):       # FIFO within a tick
+                    due.append(bucket[handle][1])
+                    del self.where[handle]
+                bucket.clear()
+            self.current += 1
+            nxt = self._next_tick()         # skip the ticks with nothing to do
+            self.current = target + 1 if nxt is None else min(nxt,target + 1)
+        return due
+
+    def _next_tick(self):
+        # First tick from current on that expires or cascades a non-empty bucket
+        low = self.current & self.mask
+        if low and (self.levels > 1 or not self.overflow):
+            # No cascade before the next block boundary: look at the rest of this block first
+            wheel = self.wheel[0]
+            for i in range(low,self.mask+1):
+                if wheel[i]:
+                    return self.current + i - low
+        ticks = []
+        for level,buckets in enumerate(self.wheel):
+            shift = self.bits*level
+            start = -(-self.current >> shift)   # the next level-`level` bucket boundary
+            for i,bucket in enumerate(buckets):
+                if bucket:
+                    ticks.append((start + ((i - start) & self.mask)) << shift)
+        if self.overflow:
+            shift = self.bits*(self.levels-1)
+            ticks.append(-(-self.current >> shift) << shift)
+        return min(ticks) if ticks else None
+
+
+'''
+wheel = TimerWheel()
+h = wheel.push(time.monotonic() + 0.5,'retry')
+wheel.remove(h)
+wheel.pop()          # everything due by now
+'''
+
+def bench_timer_wheel(n=200000,cancel=0.9,horizon=10.0):
+    '''Cancel-heavy workload: TimerWheel against the heap-based PriorityQueue'''
+    import random
+    rnd = random.Random(0)
+    dues = [rnd.uniform(0,horizon) for _ in range(n)]
+    doomed = rnd.sample(range(n),int(n*cancel))
+
+    t0 = time.perf_counter()
+    pq = PriorityQueue()
+    handles = [pq.push(-due,i) for i,due in enumerate(dues)]
+    for i in doomed:
+        pq.remove(handles[i])
+    fired = [pq.pop() for _ in range(len(pq))]
+    t1 = time.perf_counter()
+    wheel = TimerWheel(clock=lambda: 0.0)
+    handles = [wheel.push(due,i) for i,due in enumerate(dues)]
+    for i in doomed:
+        wheel.remove(handles[i])
+    fired = []
+    steps = int(horizon*100)
+    for step in range(1,steps+2):           # poll every 10 ms
+        fired.extend(wheel.pop(step*horizon/steps))
+    t2 = time.perf_counter()
+    print('{} timers, {:.0%} cancelled: PriorityQueue {:.3f}s  TimerWheel {:.3f}s'.format(
+          n,cancel,t1-t0,t2-t1))
+
 
 
 # 1.6 Mapping keys to multiple values in a dictionary
@@ -131,6 +1007,154 @@ d['a'].add(1)
 d = {}
 d.setdefault('a',[]).append(1)
 
+'''
+For many integer (key, value) pairs a list per key costs far more than the numbers
+themselves. Build into two flat typed arrays instead, then freeze: a stable sort by
+key gives CSR layout, one values buffer plus an offsets array, so the values of a key
+are a zero-copy memoryview slice.
+Lookup is O(1) when the keys are dense (offsets indexed by key directly), otherwise a
+binary search over the sorted distinct keys, still with no per-key Python objects.
+'''
+
+from array import array
+from bisect import bisect_left
+
+class ArrayMultiDict(object):
+    '''Append-only integer multidict; append() while building, then freeze()'''
+    def __init__(self,typecode='q'):
+        if typecode not in tuple('bBhHiIlLqQfd'):
+            # 'u' and 'w' are characters: np.frombuffer() cannot view them
+            raise ValueError('typecode must be a numeric array typecode, not {!r}'.format(typecode))
+        self.typecode = typecode
+        self.key_buf = array('q')
+        self.value_buf = array(typecode)
+        self.frozen = False
+
+    def append(self,key,value):
+        if self.frozen:
+            raise RuntimeError('ArrayMultiDict is frozen')
+        self.key_buf.append(key)
+        self.value_buf.append(value)
+
+    def extend(self,keys,values):
+        '''Bulk append of two parallel sequences (or arrays)'''
+        if self.frozen:
+            raise RuntimeError('ArrayMultiDict is frozen')
+        if len(keys) != len(values):
+            raise ValueError('keys and values must have the same length')
+        self.key_buf.extend(array('q',keys) if not isinstance(keys,array) else keys)
+        self.value_buf.extend(array(self.typecode,values) if not isinstance(values,array) else values)
+
+    def freeze(self):
+        '''Build the lookup arrays; later calls do nothing'''
+        if self.frozen:
+            return self
+        keys = np.frombuffer(self.key_buf,dtype=np.int64)
+        order = np.argsort(keys,kind='stable')      # keeps insertion order per key
+        keys = keys[order]
+        self.values = np.frombuffer(self.value_buf,dtype=self.typecode)[order]
+        self.view = memoryview(self.values)
+        starts = np.flatnonzero(np.r_[True,keys[1:] != keys[:-1]]) if len(keys) else np.array([],dtype=np.int64)
+        self.keys = keys[starts]
+        if len(self.keys) and self.keys[-1] - self.keys[0] < 2*len(self.keys) + 1024:
+            # Dense keys: offsets indexed by key - base, an empty slice for missing keys
+            self.base = int(self.keys[0])
+            counts = np.zeros(int(self.keys[-1]) - self.base + 1,dtype=np.int64)
+            np.add.at(counts,keys - self.base,1)
+            self.offsets = np.r_[0,np.cumsum(counts)]
+        else:
+            self.base = None
+            self.offsets = np.r_[starts,len(keys)]
+        self.key_view = memoryview(self.keys)
+        self.offset_view = memoryview(self.offsets)
+        self.key_buf = self.value_buf = None
+        self.frozen = True
+        return self
+
+    def _span(self,key):
+        # memoryviews index to plain ints, much cheaper than NumPy scalars
+        offsets = self.offset_view
+        if self.base is not None:
+            i = key - self.base
+            if 0 <= i < len(offsets) - 1 and offsets[i] != offsets[i+1]:
+                return offsets[i],offsets[i+1]
+            return None
+        keys = self.key_view
+        i = bisect_left(keys,key)
+        if i < len(keys) and keys[i] == key:
+            return offsets[i],offsets[i+1]
+        return None
+
+    def get(self,key,default=None):
+        if not self.frozen:
+            raise RuntimeError('call freeze() before looking up keys')
+        span = self._span(key)
+        return default if span is None else self.view[span[0]:span[1]]
+
+    def __getitem__(self,key):
+        values = self.get(key)
+        if values is None:
+            raise KeyError(key)
+        return values
+
+    def __contains__(self,key):
+        return self.get(key) is not None
+
+    def __len__(self):
+        '''Number of distinct keys; before freeze() counted on the buffer by NumPy'''
+        if self.frozen:
+            return len(self.keys)
+        return len(np.unique(np.frombuffer(self.key_buf,dtype=np.int64)))
+
+    def nbytes(self):
+        if not self.frozen:
+            return sum(a.itemsize*len(a) for a in (self.key_buf,self.value_buf))
+        return sum(a.nbytes for a in (self.values,self.keys,self.offsets))
+
+
+md = ArrayMultiDict()
+md.append(1,10)
+md.append(2,5)
+md.append(1,20)
+md.freeze()
+list(md[1])           # [10, 20]
+
+
+def bench_multidict(n=10**6,nkeys=10**5):
+    '''Memory and lookup time of ArrayMultiDict against defaultdict(list)'''
+    import random
+    import time
+    import tracemalloc
+    rnd = random.Random(0)
+    keys = [rnd.randrange(nkeys) for _ in range(n)]
+    values = [rnd.randrange(1<<40) for _ in range(n)]
+    probes = [rnd.randrange(nkeys) for _ in range(10**5)]
+
+    tracemalloc.start()
+    d = defaultdict(list)
+    for k,v in zip(keys,values):
+        d[k].append(v)
+    dd_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    tracemalloc.start()
+    md = ArrayMultiDict()
+    md.extend(keys,values)
+    md.freeze()
+    md_mem = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    t0 = time.perf_counter()
+    for k in probes:
+        d.get(k)
+    t1 = time.perf_counter()
+    for k in probes:
+        md.get(k)
+    t2 = time.perf_counter()
+    print('{} pairs, {} keys'.format(n,nkeys))
+    print('memory: defaultdict(list) {:.1f} MB  ArrayMultiDict {:.1f} MB'.format(dd_mem/1e6,md_mem/1e6))
+    print('lookup: defaultdict(list) {:.2f} us  ArrayMultiDict {:.2f} us'.format(
+          (t1-t0)*1e6/len(probes),(t2-t1)*1e6/len(probes)))
+
 
 
 # 1.7 Keeping dictionaries in order
@@ -179,6 +1203,374 @@ min(prices, key=lambda k: prices[k])             # get the key for the min value
 prices[min(prices, key=lambda k: prices[k])]     # get the min value
 '''
 
+'''
+Every zip() above builds one tuple per entry, and every new query does it again. For
+a large table that is queried over and over, load it once into two parallel NumPy
+arrays (names, prices) and answer with vectorised argmin/argpartition/argsort.
+min/max positions are kept up to date on single price changes; the sort order is
+cached and only recomputed after a change.
+Results come back as (price, name), like the zip() idiom. Ties go to the lower row:
+rows are numbered in load order, and a delete moves the last row into the freed one.
+'''
+
+class PriceTable(object):
+    '''Columnar name -> price table'''
+    def __init__(self,mapping=()):
+        mapping = dict(mapping)
+        self.size = len(mapping)
+        self.names = np.empty(max(self.size,8),dtype=object)
+        self.names[:self.size] = list(mapping)
+        self.values = np.zeros(max(self.size,8))
+        self.values[:self.size] = np.fromiter(mapping.values(),dtype=float,count=self.size)
+        self.row = {name:i for i,name in enumerate(mapping)}
+        self._invalidate()
+
+    def _invalidate(self):
+        self._argmin = self._argmax = self._order = None
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self,name):
+        return name in self.row
+
+    def __getitem__(self,name):
+        return float(self.values[self.row[name]])
+
+    def __setitem__(self,name,price):
+        i = self.row.get(name)
+        if i is None:
+            if self.size == len(self.values):
+                self.values = np.resize(self.values,2*self.size)
+                self.names = np.resize(self.names,2*self.size)
+            i = self.row[name] = self.size
+            self.names[i] = name
+            self.size += 1
+            old = None
+        else:
+            old = self.values[i]
+        self.values[i] = price
+        self._order = None
+        # A row can only take over min/max (a tie goes to the lower row, as with
+        # argmin/argmax), or give it up by moving away from it
+        if self._argmin is not None:
+            best = self.values[self._argmin]
+            if price < best or (price == best and i < self._argmin):
+                self._argmin = i
+            elif i == self._argmin and old is not None and price > old:
+                self._argmin = None
+        if self._argmax is not None:
+            best = self.values[self._argmax]
+            if price > best or (price == best and i < self._argmax):
+                self._argmax = i
+            elif i == self._argmax and old is not None and price < old:
+                self._argmax = None
+
+    def __delitem__(self,name):
+        i = self.row.pop(name)
+        last = self.size - 1
+        if i != last:              # move the last row into the hole
+            self.names[i],self.values[i] = self.names[last],self.values[last]
+            self.row[self.names[i]] = i
+        self.names[last] = None
+        self.size -= 1
+        self._invalidate()
+
+    def update(self,mapping):
+        for name,price in dict(mapping).items():
+            self[name] = price
+
+    def _pair(self,i):
+        return float(self.values[i]),self.names[i]
+
+    def min(self):
+        if not self.size:
+            raise ValueError('min() of an empty PriceTable')
+        if self._argmin is None:
+            self._argmin = int(np.argmin(self.values[:self.size]))
+        return self._pair(self._argmin)
+
+    def max(self):
+        if not self.size:
+            raise ValueError('max() of an empty PriceTable')
+        if self._argmax is None:
+            self._argmax = int(np.argmax(self.values[:self.size]))
+        return self._pair(self._argmax)
+
+    def _top(self,n,values):
+        n = min(n,self.size)
+        if n <= 0:
+            return []
+        idx = np.argpartition(values,n-1)[:n] if n < self.size else np.arange(self.size)
+        idx = idx[np.argsort(values[idx],kind='stable')]
+        return [self._pair(i) for i in idx.tolist()]
+
+    def nsmallest(self,n):
+        return self._top(n,self.values[:self.size])
+
+    def nlargest(self,n):
+        return self._top(n,-self.values[:self.size])
+
+    def order(self):
+        '''Row numbers in ascending price order (cached until the next change)'''
+        if self._order is None:
+            self._order = np.argsort(self.values[:self.size],kind='stable')
+        return self._order
+
+    def sorted(self,reverse=False):
+        '''(prices, names) arrays in price order'''
+        order = self.order()[::-1] if reverse else self.order()
+        return self.values[order],self.names[order]
+
+    def between(self,low,high):
+        '''(prices, names) arrays with low <= price <= high, in price order'''
+        prices,names = self.sorted()
+        lo,hi = np.searchsorted(prices,low,'left'),np.searchsorted(prices,high,'right')
+        return prices[lo:hi],names[lo:hi]
+
+
+table = PriceTable(prices)
+table.min()                  # (10.75, 'FB'), same as min(zip(prices.values(),prices.keys()))
+table.nlargest(2)
+table['FB'] = 700.0
+table.max()                  # (700.0, 'FB')
+table.between(30,250)
+
+
+def bench_price_table(n=2*10**6,queries=20):
+    '''min, max and top-10 after each single price change: zip() idiom vs PriceTable'''
+    import random
+    import time
+    rnd = random.Random(0)
+    data = {'S{}'.format(i):rnd.uniform(1,1000) for i in range(n)}
+    names = list(data)
+    t0 = time.perf_counter()
+    for _ in range(queries):
+        data[rnd.choice(names)] = rnd.uniform(1,1000)
+        min(zip(data.values(),data.keys()))
+        max(zip(data.values(),data.keys()))
+        heapq.nlargest(10,zip(data.values(),data.keys()))
+    t1 = time.perf_counter()
+    table = PriceTable(data)
+    t2 = time.perf_counter()
+    for _ in range(queries):
+        table[rnd.choice(names)] = rnd.uniform(1,1000)
+        table.min()
+        table.max()
+        table.nlargest(10)
+    t3 = time.perf_counter()
+    print('{} symbols, {} queries: zip idiom {:.2f}s  PriceTable {:.2f}s (+{:.2f}s load)'.format(
+          n,queries,t1-t0,t3-t2,t2-t1))
+
+'''
+When prices keep changing and min/max/rank are asked all the time, even one O(n) pass
+per query is too much. Keep a sorted index next to the dict and fix it up on every
+write: an indexable skip list (R. Hettinger's running-median recipe) of (price, name)
+pairs. Each link also stores how many entries it skips, so the k-th entry and the
+rank of an entry are found in O(log n) as well.
+Equal prices are ordered by name, so names must be comparable with each other.
+'''
+
+import math
+import random
+from collections.abc import MutableMapping
+
+class _End(object):
+    '''Sentinel that compares greater than anything'''
+    def __lt__(self,other): return False
+    def __le__(self,other): return False
+    def __gt__(self,other): return True
+    def __ge__(self,other): return True
+    def __eq__(self,other): return self is other
+    __hash__ = object.__hash__
+
+
+class _Node(object):
+    __slots__ = ('value','next','width')
+    def __init__(self,value,next,width):
+        self.value = value
+        self.next = next
+        self.width = width
+
+
+class IndexableSkiplist(object):
+    '''Sorted collection with O(log n) insert, remove, lookup by position and rank'''
+    def __init__(self,expected_size=1<<20):
+        self.size = 0
+        self.maxlevels = int(1 + math.log2(max(expected_size,2)))
+        self.nil = _Node(_End(),[],[])
+        self.head = _Node(None,[self.nil]*self.maxlevels,[1]*self.maxlevels)
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self,i):
+        if i < 0:
+            i += self.size
+        if not 0 <= i < self.size:
+            raise IndexError('skiplist index out of range')
+        node = self.head
+        i += 1
+        for level in reversed(range(self.maxlevels)):
+            while node.width[level] <= i:
+                i -= node.width[level]
+                node = node.next[level]
+        return node.value
+
+    def __iter__(self):
+        node = self.head.next[0]
+        while node is not self.nil:
+            yield node.value
+            node = node.next[0]
+
+    def rank(self,value):
+        '''Number of entries smaller than value'''
+        node,rank = self.head,0
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < value:
+                rank += node.width[level]
+                node = node.next[level]
+        return rank
+
+    def irange(self,low):
+        '''Iterate from the first entry >= low'''
+        node = self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < low:
+                node = node.next[level]
+        node = node.next[0]
+        while node is not self.nil:
+            yield node.value
+            node = node.next[0]
+
+    def insert(self,value):
+        # Last node before value on every level, and how far we walked on each
+        chain = [None]*self.maxlevels
+        steps_at_level = [0]*self.maxlevels
+        node = self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value <= value:
+                steps_at_level[level] += node.width[level]
+                node = node.next[level]
+            chain[level] = node
+        # Coin flips decide how many levels link to the new node
+        d = min(self.maxlevels,1 - int(math.log2(1.0 - random.random())))
+        newnode = _Node(value,[None]*d,[None]*d)
+        steps = 0
+        for level in range(d):
+            prevnode = chain[level]
+            newnode.next[level] = prevnode.next[level]
+            prevnode.next[level] = newnode
+            newnode.width[level] = prevnode.width[level] - steps
+            prevnode.width[level] = steps + 1
+            steps += steps_at_level[level]
+        for level in range(d,self.maxlevels):
+            chain[level].width[level] += 1
+        self.size += 1
+
+    def remove(self,value):
+        chain = [None]*self.maxlevels
+        node = self.head
+        for level in reversed(range(self.maxlevels)):
+            while node.next[level].value < value:
+                node = node.next[level]
+            chain[level] = node
+        if value != chain[0].next[0].value:
+            raise KeyError(value)
+        d = len(chain[0].next[0].next)
+        for level in range(d):
+            prevnode = chain[level]
+            prevnode.width[level] += prevnode.next[level].width[level] - 1
+            prevnode.next[level] = prevnode.next[level].next[level]
+        for level in range(d,self.maxlevels):
+            chain[level].width[level] -= 1
+        self.size -= 1
+
+
+class RankedDict(MutableMapping):
+    '''dict whose values are kept in a sorted index; queries return (value, key)'''
+    def __init__(self,*args,**kwargs):
+        self.data = {}
+        self.index = IndexableSkiplist()
+        self.update(*args,**kwargs)
+
+    def __getitem__(self,key):
+        return self.data[key]
+
+    def __setitem__(self,key,value):
+        if key in self.data:
+            self.index.remove((self.data[key],key))
+        self.index.insert((value,key))
+        self.data[key] = value
+
+    def __delitem__(self,key):
+        self.index.remove((self.data.pop(key),key))
+
+    def __iter__(self):
+        return iter(self.data)
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return 'RankedDict({!r})'.format(self.data)
+
+    def min(self):
+        if not self.data:
+            raise ValueError('min() of an empty RankedDict')
+        return self.index[0]
+
+    def max(self):
+        if not self.data:
+            raise ValueError('max() of an empty RankedDict')
+        return self.index[-1]
+
+    def kth(self,k):
+        '''k-th smallest (value, key), 0-based; negative k counts from the largest'''
+        return self.index[k]
+
+    def rank(self,key):
+        '''How many entries are smaller than key's'''
+        return self.index.rank((self.data[key],key))
+
+    def range(self,low,high):
+        '''(value, key) pairs with low <= value <= high, in order'''
+        for value,key in self.index.irange((low,)):
+            if value > high:
+                break
+            yield value,key
+
+
+ranked = RankedDict(prices)
+ranked.min()                 # (10.75, 'FB')
+ranked['IBM'] = 5.0
+ranked.kth(1)                # (10.75, 'FB')
+ranked.rank('AAPL')          # 4
+list(ranked.range(30,50))
+
+
+def bench_ranked_dict(n=10**5,rounds=100):
+    '''One price change then min, max and median: dict scans vs RankedDict'''
+    import time
+    rnd = random.Random(0)
+    data = {'S{}'.format(i):rnd.uniform(1,1000) for i in range(n)}
+    names = list(data)
+    ranked = RankedDict(data)
+    t0 = time.perf_counter()
+    for _ in range(rounds):
+        data[rnd.choice(names)] = rnd.uniform(1,1000)
+        min(data,key=lambda k: data[k])
+        max(data,key=lambda k: data[k])
+        sorted(zip(data.values(),data.keys()))[n//2]
+    t1 = time.perf_counter()
+    for _ in range(rounds):
+        ranked[rnd.choice(names)] = rnd.uniform(1,1000)
+        ranked.min()
+        ranked.max()
+        ranked.kth(n//2)
+    t2 = time.perf_counter()
+    print('{} keys, {} rounds: dict scans {:.2f}s  RankedDict {:.4f}s'.format(n,rounds,t1-t0,t2-t1))
+
 
 
 # 1.9 Finding commonalities in two dictionaries
@@ -204,6 +1596,131 @@ b={
 
 a.keys() &  b.keys()
 
+'''
+a.keys() & b.keys() and a.items() - b.items() build temporary sets as big as the
+inputs. For reconciling huge snapshots, stream the differences instead:
+    diff_dicts():  two mappings in memory, membership tests only, no temporary sets.
+    diff_sorted(): two (key, value) streams sorted by key, e.g. sorted dump files;
+                   a sort-merge that holds one item of each side.
+    diff_spill():  two unsorted streams; hash-partition both into temp files, then
+                   diff one partition at a time, so only ~1/partitions is in memory.
+Each yields Change(kind, key, old, new) with kind 'same', 'changed', 'added' or 'removed'.
+'''
+
+import pickle
+import tempfile
+from collections import namedtuple
+
+Change = namedtuple('Change',['kind','key','old','new'])
+
+def diff_dicts(a,b):
+    for key,old in a.items():
+        if key in b:
+            new = b[key]
+            yield Change('same' if old == new else 'changed',key,old,new)
+        else:
+            yield Change('removed',key,old,None)
+    for key,new in b.items():
+        if key not in a:
+            yield Change('added',key,None,new)
+
+def diff_sorted(a_items,b_items):
+    '''Both inputs must be sorted by key, with unique keys'''
+    end = object()
+    a_items,b_items = iter(a_items),iter(b_items)
+    a_key,a_val = next(a_items,(end,None))
+    b_key,b_val = next(b_items,(end,None))
+    while a_key is not end or b_key is not end:
+        if b_key is end or (a_key is not end and a_key < b_key):
+            yield Change('removed',a_key,a_val,None)
+            a_key,a_val = next(a_items,(end,None))
+        elif a_key is end or b_key < a_key:
+            yield Change('added',b_key,None,b_val)
+            b_key,b_val = next(b_items,(end,None))
+        else:
+            yield Change('same' if a_val == b_val else 'changed',a_key,a_val,b_val)
+            a_key,a_val = next(a_items,(end,None))
+            b_key,b_val = next(b_items,(end,None))
+
+def _spill(items,files,batch=4096):
+    '''Append (key, value) pairs to files[hash(key) % len(files)] in pickled batches'''
+    buffers = [[] for _ in files]
+    for key,value in items:
+        i = hash(key) % len(files)
+        buffers[i].append((key,value))
+        if len(buffers[i]) >= batch:
+            pickle.dump(buffers[i],files[i],pickle.HIGHEST_PROTOCOL)
+            buffers[i].clear()
+    for f,buf in zip(files,buffers):
+        if buf:
+            pickle.dump(buf,f,pickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+
+def _unspill(f):
+    while True:
+        try:
+            yield from pickle.load(f)
+        except EOFError:
+            return
+
+def diff_spill(a_items,b_items,partitions=64,tmpdir=None):
+    '''Diff two unsorted (key, value) streams with bounded memory'''
+    a_files = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(partitions)]
+    b_files = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(partitions)]
+    try:
+        _spill(a_items,a_files)
+        _spill(b_items,b_files)
+        for fa,fb in zip(a_files,b_files):
+            part = dict(_unspill(fa))
+            for key,new in _unspill(fb):
+                if key in part:
+                    old = part.pop(key)
+                    yield Change('same' if old == new else 'changed',key,old,new)
+                else:
+                    yield Change('added',key,None,new)
+            for key,old in part.items():
+                yield Change('removed',key,old,None)
+    finally:
+        for f in a_files + b_files:
+            f.close()
+
+[c for c in diff_dicts(a,b) if c.kind != 'same']
+'''
+with open('monday.tsv') as fa, open('tuesday.tsv') as fb:
+    rows = lambda f: (line.rstrip('\\n').split('\\t',1) for line in f)
+    for change in diff_sorted(rows(fa),rows(fb)):
+        ...
+'''
+
+
+def bench_diff(n=10**6,partitions=64):
+    '''Keys per second through each diff strategy'''
+    import time
+    rnd = random.Random(0)
+    a = {i:rnd.random() for i in range(n)}
+    b = dict(a)
+    for i in rnd.sample(range(n),n//10):
+        b[i] = -1.0                   # changed
+    for i in rnd.sample(range(n),n//20):
+        del b[i]                      # removed
+    for i in range(n,n+n//20):
+        b[i] = 0.0                    # added
+    t0 = time.perf_counter()
+    len(a.keys() & b.keys()),len(a.keys() - b.keys()),len(b.keys() - a.keys()),len(a.items() - b.items())
+    t1 = time.perf_counter()
+    for _ in diff_dicts(a,b):
+        pass
+    t2 = time.perf_counter()
+    for _ in diff_sorted(sorted(a.items()),sorted(b.items())):
+        pass
+    t3 = time.perf_counter()
+    for _ in diff_spill(a.items(),b.items(),partitions):
+        pass
+    t4 = time.perf_counter()
+    rate = lambda t: (len(a)+len(b))/t/1e6
+    print('set ops {:.2f} M keys/s  diff_dicts {:.2f}  diff_sorted (incl. sort) {:.2f}  diff_spill {:.2f}'.format(
+          rate(t1-t0),rate(t2-t1),rate(t3-t2),rate(t4-t3)))
+
 
 
 
@@ -240,6 +1757,415 @@ def dedupe(items,key=None):
 a = [ {'x':1, 'y':2}, {'x':1, 'y':3}, {'x':1, 'y':2}, {'x':2, 'y':4}]
 list(dedupe(a,key=lambda d: (d['x'],d['y'])))
 
+'''
+seen grows with every distinct value. Two bounded-memory alternatives:
+    dedupe_approx(): a scalable Bloom filter instead of the set. A new value is
+        wrongly taken for a duplicate (and dropped) with probability up to
+        error_rate. Memory, measured for 10**5 to 10**6 distinct values, is 1.7 to
+        4 bytes per value at a 1% error rate, up to 5 at 0.1%: every new slice gets
+        a tighter error rate, so more bits per value, and the newest slice is
+        allocated in full before it fills. Values are hashed by their bytes (str,
+        bytes) or their repr, so 1 and 1.0 count as different values.
+    dedupe_spill(): exact. Hash-partitions the keys to temp files and dedupes one
+        partition at a time. It has to see the whole input before it can yield.
+'''
+
+import hashlib
+
+def _hash_pair(value):
+    # Two full-width 64-bit hashes from one blake2b digest of the value's bytes;
+    # double hashing derives every probe from them. hash() would not do: values
+    # with the same hash (hash(-1) == hash(-2)) would collide on every probe.
+    if isinstance(value,str):
+        data = b's' + value.encode('utf-8','surrogatepass')
+    elif isinstance(value,bytes):
+        data = b'b' + value
+    else:
+        data = b'r' + repr(value).encode('utf-8','surrogatepass')
+    digest = hashlib.blake2b(data,digest_size=16).digest()
+    return int.from_bytes(digest[:8],'little'),int.from_bytes(digest[8:],'little') | 1
+
+class BloomFilter(object):
+    '''Fixed-capacity Bloom filter over hashable values'''
+    def __init__(self,capacity,error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        # k = log2(1/p) probes and k/ln2 bits per value keep the error at most p
+        self.nhashes = max(1,math.ceil(-math.log2(error_rate)))
+        self.nbits = math.ceil(capacity*self.nhashes/math.log(2))
+        self.bits = bytearray((self.nbits+7)//8)
+        self.count = 0
+
+    def _contains(self,h1,h2):
+        bits,nbits = self.bits,self.nbits
+        for i in range(self.nhashes):
+            p = (h1 + i*h2) % nbits
+            if not bits[p >> 3] & (1 << (p & 7)):
+                return False
+        return True
+
+    def _add(self,h1,h2):
+        bits,nbits = self.bits,self.nbits
+        present = True
+        for i in range(self.nhashes):
+            p = (h1 + i*h2) % nbits
+            mask = 1 << (p & 7)
+            if not bits[p >> 3] & mask:
+                bits[p >> 3] |= mask
+                present = False
+        if not present:
+            self.count += 1
+        return present
+
+    def __contains__(self,value):
+        return self._contains(*_hash_pair(value))
+
+    def add(self,value):
+        '''Add value; returns True if it was (probably) there already'''
+        return self._add(*_hash_pair(value))
+
+    def nbytes(self):
+        return len(self.bits)
+
+
+class ScalableBloomFilter(object):
+    '''
+    Chain of Bloom filters that grows as values arrive. Filter i gets error rate
+    error_rate*(1-r)*r**i, so the total stays below error_rate.
+    '''
+    def __init__(self,initial_capacity=1<<16,error_rate=0.001,growth=2,ratio=0.5):
+        self.error_rate = error_rate
+        self.growth = growth
+        self.ratio = ratio
+        self.filters = [BloomFilter(initial_capacity,error_rate*(1-ratio))]
+
+    def __contains__(self,value):
+        h1,h2 = _hash_pair(value)
+        return any(f._contains(h1,h2) for f in reversed(self.filters))
+
+    def add(self,value):
+        h1,h2 = _hash_pair(value)
+        for f in reversed(self.filters):      # the newest filter is the biggest
+            if f._contains(h1,h2):
+                return True
+        last = self.filters[-1]
+        if last.count >= last.capacity:
+            last = BloomFilter(last.capacity*self.growth,last.error_rate*self.ratio)
+            self.filters.append(last)
+        last._add(h1,h2)
+        return False
+
+    def nbytes(self):
+        return sum(f.nbytes() for f in self.filters)
+
+
+def dedupe_approx(items,key=None,error_rate=0.001,initial_capacity=1<<16):
+    seen = ScalableBloomFilter(initial_capacity,error_rate)
+    for item in items:
+        value = item if key is None else key(item)
+        if not seen.add(value):
+            yield item
+
+
+def dedupe_spill(items,key=None,partitions=64,tmpdir=None):
+    '''
+    Exact dedupe in bounded memory; values must be picklable.
+    Pass 1 logs the items in order and spills (value, position) by hash(value);
+    pass 2 finds the first position of each value one partition at a time;
+    pass 3 replays the log, yielding the items at those positions.
+    '''
+    log = tempfile.TemporaryFile(dir=tmpdir)
+    parts = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(partitions)]
+    firsts = [tempfile.TemporaryFile(dir=tmpdir) for _ in range(partitions)]
+    try:
+        def logged(batch=4096):
+            buf = []
+            for n,item in enumerate(items):
+                buf.append(item)
+                if len(buf) >= batch:
+                    pickle.dump(buf,log,pickle.HIGHEST_PROTOCOL)
+                    buf = []
+                yield (item if key is None else key(item)),n
+            if buf:
+                pickle.dump(buf,log,pickle.HIGHEST_PROTOCOL)
+            log.seek(0)
+        _spill(logged(),parts)
+
+        for part,first in zip(parts,firsts):
+            seen = set()
+            positions = array('q')
+            for value,n in _unspill(part):
+                if value not in seen:
+                    seen.add(value)
+                    positions.append(n)
+            positions.tofile(first)      # ascending, positions were spilled in order
+            first.seek(0)
+            part.close()
+
+        def read_positions(f,chunk=1<<16):
+            while True:
+                a = array('q')
+                try:
+                    a.fromfile(f,chunk)
+                except EOFError:
+                    yield from a
+                    return
+                yield from a
+
+        keep = heapq.merge(*(read_positions(f) for f in firsts))
+        wanted = next(keep,None)
+        for n,item in enumerate(_unspill(log)):
+            if n == wanted:
+                yield item
+                wanted = next(keep,None)
+    finally:
+        for f in [log] + parts + firsts:
+            f.close()
+
+
+list(dedupe_approx(a,key=lambda d: (d['x'],d['y'])))
+list(dedupe_spill(a,key=lambda d: (d['x'],d['y']),partitions=4))
+
+
+'''
+On an endless stream "duplicate" usually means "seen within the last N items" or
+"within the last T seconds", and older values can be forgotten. Keep the values in
+an OrderedDict ordered by when they were last seen: expiry pops from the front and a
+repeat moves to the back, both O(1).
+'''
+
+from collections import OrderedDict
+
+class WindowedDedupe(object):
+    '''
+    Forgets values not seen in the last maxitems items and/or ttl seconds.
+    refresh=True measures the window from the last sighting, False from the first.
+    '''
+    def __init__(self,key=None,maxitems=None,ttl=None,refresh=True,clock=time.monotonic):
+        if maxitems is None and ttl is None:
+            raise ValueError('give maxitems, ttl or both')
+        self.key = key
+        self.maxitems = maxitems
+        self.ttl = ttl
+        self.refresh = refresh
+        self.clock = clock
+        self.seen = OrderedDict()     # value -> (position, time) of the sighting
+        self.position = 0
+        self.hits = 0                 # duplicates dropped
+        self.evictions = 0            # values forgotten
+
+    def __len__(self):
+        return len(self.seen)
+
+    def _expire(self,now):
+        seen = self.seen
+        while seen:
+            position,stamp = next(iter(seen.values()))
+            if ((self.maxitems is not None and self.position - position >= self.maxitems) or
+                    (self.ttl is not None and now - stamp >= self.ttl)):
+                seen.popitem(last=False)
+                self.evictions += 1
+            else:
+                break
+
+    def add(self,value):
+        '''Record value; returns True if it is a duplicate within the window'''
+        now = self.clock() if self.ttl is not None else None
+        self.position += 1
+        self._expire(now)
+        if value in self.seen:
+            self.hits += 1
+            if self.refresh:
+                self.seen[value] = (self.position,now)
+                self.seen.move_to_end(value)
+            return True
+        self.seen[value] = (self.position,now)
+        return False
+
+    def filter(self,items):
+        key = self.key
+        for item in items:
+            if not self.add(item if key is None else key(item)):
+                yield item
+
+    def stats(self):
+        return {'hits': self.hits,'evictions': self.evictions,'size': len(self.seen)}
+
+
+w = WindowedDedupe(maxitems=3)
+list(w.filter([1, 2, 1, 3, 4, 5, 1]))      # [1, 2, 3, 4, 5, 1]
+w.stats()
+'''
+w = WindowedDedupe(key=lambda e: e['id'],ttl=600)     # duplicates within 10 minutes
+for event in w.filter(events):
+    ...
+'''
+
+
+'''
+The key= lambda builds a tuple per row in Python. For NumPy data, dedupe whole batches:
+a stable argsort puts equal values next to each other with the first row leading its
+run, the run starts give the first row of each value, and searchsorted checks those
+against the values of earlier batches. Earlier values are
+kept as a few sorted runs that merge as they grow, like a log-structured merge tree,
+so a batch costs O(b log n) and does not copy everything seen so far.
+Rows of a 2-D array or of a dict of columns are sorted by a 64-bit hash and compared
+as raw bytes where hashes meet, so all batches must have the same dtypes, and -0.0
+differs from 0.0.
+'''
+
+class ArrayDedupe(object):
+    '''Vectorised dedupe over a stream of NumPy batches'''
+    def __init__(self):
+        self.runs = []       # (sorted keys, rows or None), sizes roughly halving
+
+    def __len__(self):
+        return sum(len(keys) for keys,_ in self.runs)
+
+    def _rows(self,batch):
+        '''1-D plain arrays as they are, anything else as one raw-bytes value per row'''
+        if isinstance(batch,dict):
+            batch = np.rec.fromarrays([np.asarray(col) for col in batch.values()],
+                                      names=list(batch))
+        else:
+            batch = np.asarray(batch)
+            if batch.ndim == 1 and batch.dtype.names is None:
+                return batch,None
+        rows = np.ascontiguousarray(batch)
+        width = rows.dtype.itemsize * (rows.shape[1] if rows.ndim == 2 else 1)
+        rows = rows.view(np.dtype((np.void,width))).ravel()
+        return self._hash(rows),rows
+
+    @staticmethod
+    def _hash(rows):
+        # Sorting raw bytes is slow, so sort 64-bit row hashes and compare the rows
+        # themselves only where hashes are equal.
+        width = rows.dtype.itemsize
+        words = np.zeros((len(rows),-(-width//8)*8),dtype=np.uint8)
+        words[:,:width] = rows.view(np.uint8).reshape(len(rows),width)
+        words = words.view(np.uint64)
+        h = np.full(len(rows),0xcbf29ce484222325,dtype=np.uint64)
+        for j in range(words.shape[1]):
+            h ^= words[:,j]
+            h *= np.uint64(0x100000001b3)
+            h ^= h >> np.uint64(29)
+        return h
+
+    def _seen(self,key,row):
+        for keys,rows in self.runs:
+            lo,hi = np.searchsorted(keys,key,'left'),np.searchsorted(keys,key,'right')
+            if lo < hi and (rows is None or (rows[lo:hi] == row).any()):
+                return True
+        return False
+
+    def _add_run(self,keys,rows):
+        self.runs.append((keys,rows))
+        while len(self.runs) > 1 and len(self.runs[-2][0]) <= 2*len(self.runs[-1][0]):
+            (newer,new_rows),(older,old_rows) = self.runs.pop(),self.runs.pop()
+            keys = np.concatenate([older,newer])
+            order = np.argsort(keys,kind='stable')     # two sorted runs: a merge
+            rows = None if new_rows is None else np.concatenate([old_rows,new_rows])[order]
+            self.runs.append((keys[order],rows))
+
+    def first_indices(self,batch):
+        '''Indices of the rows of batch never seen before, in order'''
+        keys,rows = self._rows(batch)
+        n = len(keys)
+        if not n:
+            return np.empty(0,dtype=np.intp)
+        order = np.argsort(keys,kind='stable')
+        skeys = keys[order]
+        lead = np.r_[True,skeys[1:] != skeys[:-1]]
+        if rows is not None:
+            srows = rows[order]
+            leader = np.maximum.accumulate(np.where(lead,np.arange(n),0))
+            if (srows != srows[leader]).any():
+                return self._first_indices_slow(keys,rows)     # two rows share a hash
+        index,ukeys = order[lead],skeys[lead]
+        urows = None if rows is None else srows[lead]
+        fresh = np.ones(len(index),dtype=bool)
+        for run_keys,run_rows in self.runs:
+            pos = np.searchsorted(run_keys,ukeys)
+            hit = pos < len(run_keys)
+            hit[hit] = run_keys[pos[hit]] == ukeys[hit]
+            if run_rows is not None and hit.any():
+                hits = np.flatnonzero(hit)
+                same = run_rows[pos[hits]] == urows[hits]
+                for j in np.flatnonzero(~same):
+                    # A hash collides with another row; settle those few exactly
+                    same[j] = self._seen(ukeys[hits[j]],urows[hits[j]])
+                hit[hits] = same
+            fresh &= ~hit
+        if fresh.any():
+            self._add_run(ukeys[fresh],None if urows is None else urows[fresh])
+        return np.sort(index[fresh])
+
+    def _first_indices_slow(self,keys,rows):
+        index,local = [],set()
+        for i in range(len(keys)):
+            value = (int(keys[i]),rows[i].tobytes())
+            if value not in local and not self._seen(keys[i],rows[i]):
+                local.add(value)
+                index.append(i)
+        index = np.array(index,dtype=np.intp)
+        order = np.argsort(keys[index],kind='stable')
+        self._add_run(keys[index][order],rows[index][order])
+        return index
+
+    def dedupe(self,batch):
+        '''The new rows of batch: an array, or a dict of columns'''
+        index = self.first_indices(batch)
+        if isinstance(batch,dict):
+            return {name: np.asarray(col)[index] for name,col in batch.items()}
+        return np.asarray(batch)[index]
+
+
+ArrayDedupe().dedupe(np.array([1, 5, 2, 1, 9, 1, 5, 10]))     # array([ 1,  5,  2,  9, 10])
+
+seen = ArrayDedupe()
+seen.dedupe({'x': np.array([1, 1, 1, 2]), 'y': np.array([2, 3, 2, 4])})
+seen.dedupe({'x': np.array([2, 3]), 'y': np.array([4, 4])})      # only x=3, y=4 is new
+
+
+def bench_array_dedupe(n=10**6,batch=10**5):
+    '''Rows/s: dedupe() with a key lambda over dicts vs ArrayDedupe over column batches'''
+    import time
+    rnd = np.random.default_rng(0)
+    x = rnd.integers(0,1000,n)
+    y = rnd.integers(0,1000,n)
+    rows = [{'x':a,'y':b} for a,b in zip(x.tolist(),y.tolist())]
+    t0 = time.perf_counter()
+    kept = sum(1 for _ in dedupe(rows,key=lambda d: (d['x'],d['y'])))
+    t1 = time.perf_counter()
+    seen = ArrayDedupe()
+    kept_array = sum(len(seen.first_indices({'x':x[i:i+batch],'y':y[i:i+batch]}))
+                     for i in range(0,n,batch))
+    t2 = time.perf_counter()
+    assert kept == kept_array
+    print('{} rows: dedupe(key=lambda) {:.2f} M rows/s  ArrayDedupe {:.2f} M rows/s'.format(
+          n,n/(t1-t0)/1e6,n/(t2-t1)/1e6))
+
+
+def bench_dedupe(n=5*10**5,distinct=2*10**5):
+    '''Peak memory and items/s: set-based dedupe() vs dedupe_approx() vs dedupe_spill()'''
+    import time
+    import tracemalloc
+    rnd = random.Random(0)
+    data = [rnd.randrange(1<<40) for _ in range(distinct)]
+    data = [rnd.choice(data) for _ in range(n)]
+    for name,func in [('set',lambda: dedupe(data)),
+                      ('approx 1%',lambda: dedupe_approx(data,error_rate=0.01)),
+                      ('approx 0.1%',lambda: dedupe_approx(data,error_rate=0.001)),
+                      ('spill',lambda: dedupe_spill(data))]:
+        t0 = time.perf_counter()
+        kept = sum(1 for _ in func())
+        t = time.perf_counter() - t0
+        tracemalloc.start()          # second run, tracing slows it down too much to time
+        sum(1 for _ in func())
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        print('{:12s} {:.2f} M items/s  peak {:6.1f} MB  kept {}'.format(name,n/t/1e6,peak/1e6,kept))
+
 
 
 # 1.11 Naming a slice
@@ -264,6 +2190,109 @@ PRICE  = slice(40,48)
     
 cost = int(record[SHARES]) * float(record[PRICE])
 
+'''
+On a big fixed-width file, int()/float() per field per record is the bottleneck.
+Declare the named slices and their types once in a RecordLayout. It maps the file
+and decodes a block of records at a time into a NumPy structured array: each field
+is cut out of the block as one fixed-width bytes column and converted by astype(),
+with no Python call per field.
+'''
+
+class RecordLayout(object):
+    '''
+    fields: [(name, slice, int|float|bytes), ...]; records have the same length,
+    record_size, or else up to and including the first newline of each buffer or file
+    '''
+    def __init__(self,fields,record_size=None):
+        self.fields = []
+        for name,s,kind in fields:
+            start = s.start or 0
+            if s.step not in (None,1) or s.stop is None or not 0 <= start < s.stop or kind not in (int,float,bytes):
+                raise ValueError('field {!r}: need a plain slice and int, float or bytes'.format(name))
+            self.fields.append((name,slice(start,s.stop),kind))
+        self.record_size = record_size
+        self.dtype = np.dtype([(name,{int: np.int64,float: np.float64}.get(kind,'S{}'.format(s.stop-s.start)))
+                               for name,s,kind in self.fields])
+
+    def _record_size(self,buf):
+        # record_size if given, else up to and including the first newline
+        if self.record_size is not None:
+            return self.record_size
+        head = bytes(memoryview(buf)[:1<<16])
+        size = head.find(b'\n') + 1
+        if size == 0 and len(head) < len(buf):
+            raise ValueError('no record_size given, and no newline ends the first record')
+        return size or len(head) or 1
+
+    def parse(self,buf,record_size=None):
+        '''Decode a buffer holding whole records; the last may lack its newline'''
+        size = record_size or self._record_size(buf)
+        flat = np.frombuffer(buf,dtype=np.uint8)
+        n,tail = divmod(len(flat),size)
+        if tail:
+            if tail != size - 1 or flat[size-1] != 10:
+                raise ValueError('{} bytes left over after {} records of {} bytes'.format(tail,n,size))
+            flat = np.concatenate((flat,np.array([10],dtype=np.uint8)))     # the last record lacks its '\n'
+            n += 1
+        raw = flat.reshape(n,size)
+        out = np.empty(n,dtype=self.dtype)
+        for name,s,kind in self.fields:
+            # One contiguous copy of the column as fixed-width bytes; NumPy converts it,
+            # surrounding blanks included, with no Python call per record
+            cols = np.ascontiguousarray(raw[:,s]).view('S{}'.format(s.stop-s.start)).ravel()
+            out[name] = cols if kind is bytes else cols.astype(kind)
+        return out
+
+    def parse_file(self,filename,block_records=1<<18):
+        '''Yield structured arrays of up to block_records records each'''
+        if os.path.getsize(filename) == 0:
+            return
+        with open(filename,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+            size = self.record_size or mm.find(b'\n') + 1 or len(mm)
+            block = block_records * size
+            view = memoryview(mm)
+            try:
+                for start in range(0,len(mm),block):
+                    yield self.parse(view[start:start+block],size)
+            finally:
+                view.release()
+
+
+layout = RecordLayout([('shares',SHARES,int),('price',PRICE,float)],record_size=len(record))
+rows = layout.parse(record.encode())
+cost = rows['shares'] * rows['price']
+two = RecordLayout([('shares',slice(0,4),int),('price',slice(4,9),float)]).parse(b'  12  3.5\n  13  4.5')
+assert two.tolist() == [(12,3.5),(13,4.5)]          # no newline after the last record
+'''
+for block in layout.parse_file('trades.dat'):
+    total += (block['shares'] * block['price']).sum()
+'''
+
+
+def bench_record_layout(n=10**6):
+    '''records/s: slice-and-convert loop vs RecordLayout.parse_file()'''
+    import time
+    rnd = random.Random(0)
+    with tempfile.NamedTemporaryFile('w',suffix='.dat',delete=False) as f:
+        for _ in range(n):
+            f.write('.'*20 + format(rnd.randrange(10**6),'<12d') + '.'*8 +
+                    format(rnd.randrange(10**7)/100,'<8.2f') + '.'*10 + '\n')
+        filename = f.name
+    try:
+        t0 = time.perf_counter()
+        with open(filename) as f:
+            loop_total = sum(int(line[SHARES]) * float(line[PRICE]) for line in f)
+        t1 = time.perf_counter()
+        layout = RecordLayout([('shares',SHARES,int),('price',PRICE,float)])
+        total = sum(float((block['shares'] * block['price']).sum())
+                    for block in layout.parse_file(filename))
+        t2 = time.perf_counter()
+        assert abs(total - loop_total) <= 1e-9 * abs(loop_total)
+        print('{} records: slice loop {:.2f} M/s  RecordLayout {:.2f} M/s  ({:.0f}x)'.format(
+              n,n/(t1-t0)/1e6,n/(t2-t1)/1e6,(t1-t0)/(t2-t1)))
+    finally:
+        os.remove(filename)
+
 
 
 # 1.12 Determining the most frequently occuring items in a sequence
@@ -300,6 +2329,420 @@ top_three = word_counts.most_common(3)
 morewords = ['why','are','you','not','looking','in','my','eyes']
 word_counts.update(morewords)
 
+'''
+The same counting over a corpus that is much bigger than one machine's memory.
+count_words() is a map/reduce over a process pool: the files are cut into
+line-aligned shards (_shards() from 1.3), each worker decodes its shards and counts
+them with one Counter, and the Counters come back to be merged. A Counter holds one
+entry per distinct word, so shipping it back and merging it costs an order of
+magnitude less than the counting that produced it. With one worker
+there is no pool at all: the shards are counted in this process.
+
+When even the vocabulary is too big, top_words() keeps bounded state per worker:
+    CountMinSketch: depth rows of width counters. A word adds its count to one
+        counter per row, and its estimate is the smallest of those counters. It
+        never undercounts, and it overcounts by at most e*total/width with
+        probability 1 - exp(-depth).
+    SpaceSaving: at most k words with their counts. A new word takes over the
+        smallest count (and records it as its possible error). Any word counted
+        more than total/k times is kept.
+Both merge: the sketch tables add up, and two summaries merge into one of k words.
+'''
+
+import hashlib
+from collections.abc import Mapping
+from operator import itemgetter
+
+def _stable_hash(word):
+    # hash() of str/bytes changes between processes; sketches built in different
+    # workers must agree
+    if isinstance(word,str):
+        word = word.encode('utf-8','surrogatepass')
+    return int.from_bytes(hashlib.blake2b(word,digest_size=8).digest(),'little')
+
+
+class CountMinSketch(object):
+    '''Approximate counts of str/bytes keys in depth*width counters'''
+    def __init__(self,width=1<<20,depth=4):
+        self.width = width
+        self.depth = depth
+        self.table = np.zeros((depth,width),dtype=np.int64)
+        self.total = 0
+
+    @classmethod
+    def from_error(cls,epsilon=1e-5,delta=1e-3):
+        '''Overcount at most epsilon*total with probability 1-delta'''
+        return cls(math.ceil(math.e/epsilon),math.ceil(math.log(1/delta)))
+
+    def _columns(self,keys):
+        h = np.fromiter((_stable_hash(key) for key in keys),dtype=np.uint64,count=len(keys))
+        h1, h2 = h & 0xffffffff, (h >> 32) | 1
+        return [(h1 + i*h2) % self.width for i in range(self.depth)]
+
+    def update(self,counts):
+        '''Add a mapping of key -> count, or count an iterable of keys'''
+        if not isinstance(counts,Mapping):
+            counts = Counter(counts)
+        keys = list(counts)
+        values = np.fromiter(counts.values(),dtype=np.int64,count=len(keys))
+        for row,columns in zip(self.table,self._columns(keys)):
+            np.add.at(row,columns.astype(np.intp),values)
+        self.total += int(values.sum())
+
+    def __getitem__(self,key):
+        return int(min(row[c[0]] for row,c in zip(self.table,self._columns([key]))))
+
+    def merge(self,other):
+        if self.table.shape != other.table.shape:
+            raise ValueError('sketches differ in width or depth')
+        self.table += other.table
+        self.total += other.total
+        return self
+
+    def nbytes(self):
+        return self.table.nbytes
+
+
+class SpaceSaving(object):
+    '''The k (probably) most frequent keys of a stream, in O(k) memory'''
+    def __init__(self,k):
+        self.k = k
+        self.counts = {}
+        self.errors = {}
+        self._heap = []          # (count, key); stale when count is no longer current
+
+    def _push(self,key,count):
+        heapq.heappush(self._heap,(count,key))
+        if len(self._heap) > 2*self.k + 64:
+            self._heap = [(c,x) for x,c in self.counts.items()]
+            heapq.heapify(self._heap)
+
+    def _pop_min(self):
+        while True:
+            count,key = heapq.heappop(self._heap)
+            if self.counts.get(key) == count:
+                return key,count
+
+    def add(self,key,count=1):
+        counts = self.counts
+        if key in counts:
+            counts[key] += count
+        elif len(counts) < self.k:
+            counts[key] = count
+            self.errors[key] = 0
+        else:
+            victim,floor = self._pop_min()
+            del counts[victim], self.errors[victim]
+            counts[key] = floor + count
+            self.errors[key] = floor
+        self._push(key,counts[key])
+
+    def update(self,counts):
+        '''Add a mapping of key -> count, or count an iterable of keys'''
+        if not isinstance(counts,Mapping):
+            counts = Counter(counts)
+        for key,count in counts.items():
+            self.add(key,count)
+
+    def floor(self):
+        '''Count of a key that is not kept is at most this'''
+        return min(self.counts.values()) if len(self.counts) >= self.k else 0
+
+    def merge(self,other):
+        a,b = self.floor(),other.floor()
+        keys = self.counts.keys() | other.counts.keys()
+        counts = {x: self.counts.get(x,a) + other.counts.get(x,b) for x in keys}
+        errors = {x: self.errors.get(x,a) + other.errors.get(x,b) for x in keys}
+        kept = heapq.nlargest(self.k,counts.items(),key=itemgetter(1))
+        self.counts = dict(kept)
+        self.errors = {x: errors[x] for x,_ in kept}
+        self._heap = [(c,x) for x,c in kept]
+        heapq.heapify(self._heap)
+        return self
+
+    def most_common(self,n=None):
+        '''[(key, count), ...]; each count overestimates by at most errors[key]'''
+        if n is None:
+            return sorted(self.counts.items(),key=itemgetter(1),reverse=True)
+        return heapq.nlargest(n,self.counts.items(),key=itemgetter(1))
+
+
+def _decode_words(counts):
+    return {(w.decode('utf-8','surrogateescape') if isinstance(w,bytes) else w): n
+            for w,n in counts.items()}
+
+def _shard_words(shard,tokenize):
+    filename,start,stop = shard
+    with open(filename,'rb') as f, mmap.mmap(f.fileno(),0,access=mmap.ACCESS_READ) as mm:
+        buf = mm[start:stop]
+    if tokenize is None:
+        # str.split() of the decoded shard beats bytes.split() plus decoding each word
+        return buf.decode('utf-8','surrogateescape').split()
+    return tokenize(buf)
+
+def _count_shards(shards,tokenize):
+    counts = Counter()
+    for shard in shards:
+        counts.update(_shard_words(shard,tokenize))
+    return counts
+
+def _groups(items,n):
+    return [g for g in (items[i::n] for i in range(n)) if g]
+
+def count_words(filenames,workers=None,tokenize=None,shard_size=1<<26):
+    '''
+    Exact word counts over many files, as a Counter.
+    tokenize(bytes) -> words must be a module-level function (it is pickled); the
+    default splits the text on whitespace. bytes words come back decoded from UTF-8.
+    '''
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    workers = workers or os.cpu_count()
+    shards = list(_shards(filenames,shard_size))
+    if workers == 1 or len(shards) <= 1:
+        total = _count_shards(shards,tokenize)
+    else:
+        groups = _groups(shards,workers)
+        total = Counter()
+        with ProcessPoolExecutor(len(groups)) as pool:
+            for counts in pool.map(_count_shards,groups,[tokenize]*len(groups)):
+                if total:
+                    total.update(counts)
+                else:
+                    total = counts
+    if tokenize is not None:
+        total = Counter(_decode_words(total))
+    return total
+
+def _sketch_shards(shards,tokenize,k,width,depth):
+    sketch,top = CountMinSketch(width,depth),SpaceSaving(k)
+    for shard in shards:
+        counts = Counter(_shard_words(shard,tokenize))
+        sketch.update(counts)
+        top.update(counts)
+    return sketch,top
+
+def top_words(filenames,k=100,workers=None,tokenize=None,width=1<<20,depth=4,shard_size=1<<26):
+    '''
+    Bounded-memory heavy hitters over many files.
+    Returns ([(word, count), ...] for up to k words, CountMinSketch of all words).
+    Counts are upper bounds: the smaller of the two sketches' estimates.
+    '''
+    if isinstance(filenames,str):
+        filenames = [filenames]
+    workers = workers or os.cpu_count()
+    groups = _groups(list(_shards(filenames,shard_size)),workers)
+    sketch,top = CountMinSketch(width,depth),SpaceSaving(k)
+    n = len(groups)
+    with ProcessPoolExecutor(workers) as pool:
+        for s,t in pool.map(_sketch_shards,groups,[tokenize]*n,[k]*n,[width]*n,[depth]*n):
+            sketch.merge(s)
+            top.merge(t)
+    words = [(word,min(n,sketch[word])) for word,n in top.most_common()]
+    words.sort(key=itemgetter(1),reverse=True)
+    return [(w.decode('utf-8','surrogateescape') if isinstance(w,bytes) else w,n)
+            for w,n in words],sketch
+
+'''
+if __name__ == '__main__':
+    import glob
+    counts = count_words(glob.glob('corpus/*.txt'))
+    print(counts.most_common(10))
+    top,sketch = top_words(glob.glob('corpus/*.txt'),k=1000)
+    print(top[:10],sketch['eyes'])
+'''
+
+
+def bench_count_words(nwords=2*10**6,vocabulary=10**5,max_workers=None):
+    '''words/s of count_words() and top_words() at 1..max_workers workers'''
+    rnd = random.Random(0)
+    # Zipf-like: word i has weight 1/(i+1)
+    weights = [1/(i+1) for i in range(vocabulary)]
+    vocab = ['w{}'.format(i) for i in range(vocabulary)]
+    with tempfile.NamedTemporaryFile('w',suffix='.txt',delete=False) as f:
+        for i in range(0,nwords,10**5):
+            line = rnd.choices(vocab,weights,k=min(10**5,nwords-i))
+            for j in range(0,len(line),12):
+                f.write(' '.join(line[j:j+12]) + '\n')
+        filename = f.name
+    try:
+        t0 = time.perf_counter()
+        with open(filename) as f:
+            expected = Counter(f.read().split())
+        print('single process Counter: {:.2f} M words/s'.format(nwords/(time.perf_counter()-t0)/1e6))
+        for workers in range(1,(max_workers or os.cpu_count())+1):
+            shard_size = max(1<<16,os.path.getsize(filename)//(4*workers))
+            t0 = time.perf_counter()
+            counts = count_words(filename,workers,shard_size=shard_size)
+            t1 = time.perf_counter()
+            top,sketch = top_words(filename,100,workers,width=1<<18,shard_size=shard_size)
+            t2 = time.perf_counter()
+            assert counts == expected
+            assert all(n >= expected[w] for w,n in top)
+            print('{} workers: count_words {:.2f} M words/s  top_words {:.2f} M words/s'.format(
+                  workers,nwords/(t1-t0)/1e6,nwords/(t2-t1)/1e6))
+    finally:
+        os.remove(filename)
+
+
+'''
+most_common(n) sorts (or heap-selects) the whole vocabulary on every call. LiveCounter
+keeps its keys ordered by count as they change: keys with the same count share a
+bucket, and the buckets form a doubly linked list from the highest count down. A +1
+or -1 moves a key to the neighbouring bucket in O(1), and most_common(n) walks the
+first n keys. A jump to a count with no bucket walks past the buckets in between.
+Keys with the same count come out in the order they reached that count.
+'''
+
+from itertools import islice
+
+class _Bucket(object):
+    __slots__ = ('count','keys','prev','next')
+    def __init__(self,count):
+        self.count = count
+        self.keys = {}           # insertion-ordered set
+        self.prev = self.next = None
+
+
+class LiveCounter(Counter):
+    '''Counter whose most_common(n) is O(n)'''
+    def __init__(self,iterable=None,**kwds):
+        self._buckets = {}
+        self._head = self._tail = None
+        super().__init__(iterable,**kwds)
+
+    def _link(self,bucket,near):
+        if near is None:
+            self._head = self._tail = bucket
+            return
+        p = near
+        if bucket.count > p.count:
+            while p.prev is not None and p.prev.count < bucket.count:
+                p = p.prev
+            bucket.prev,bucket.next = p.prev,p
+            if p.prev is None:
+                self._head = bucket
+            else:
+                p.prev.next = bucket
+            p.prev = bucket
+        else:
+            while p.next is not None and p.next.count > bucket.count:
+                p = p.next
+            bucket.prev,bucket.next = p,p.next
+            if p.next is None:
+                self._tail = bucket
+            else:
+                p.next.prev = bucket
+            p.next = bucket
+
+    def _unlink(self,bucket):
+        if bucket.prev is None:
+            self._head = bucket.next
+        else:
+            bucket.prev.next = bucket.next
+        if bucket.next is None:
+            self._tail = bucket.prev
+        else:
+            bucket.next.prev = bucket.prev
+        del self._buckets[bucket.count]
+
+    def _move(self,key,old,new):
+        buckets = self._buckets
+        source = None if old is None else buckets[old]
+        target = buckets.get(new)
+        if target is None:
+            target = buckets[new] = _Bucket(new)
+            self._link(target,self._tail if source is None else source)
+        target.keys[key] = None
+        if source is not None:
+            del source.keys[key]
+            if not source.keys:
+                self._unlink(source)
+
+    def __setitem__(self,key,value):
+        old = dict.get(self,key)
+        dict.__setitem__(self,key,value)
+        if old is None or old != value:
+            self._move(key,old,value)
+
+    def __delitem__(self,key):
+        '''Like Counter, deleting a missing key does nothing'''
+        if key not in self:
+            return
+        count = dict.pop(self,key)
+        bucket = self._buckets[count]
+        del bucket.keys[key]
+        if not bucket.keys:
+            self._unlink(bucket)
+
+    def update(self,iterable=None,**kwds):
+        # Counter.update() fills an empty counter with dict.update(), which
+        # would bypass __setitem__
+        if isinstance(iterable,Mapping):
+            for key,count in iterable.items():
+                self[key] = count + self.get(key,0)
+        elif iterable is not None:
+            super().update(iterable)
+        if kwds:
+            self.update(kwds)
+
+    def pop(self,key,*default):
+        if key in self:
+            count = self[key]
+            del self[key]
+            return count
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def popitem(self):
+        key,count = dict.popitem(self)
+        dict.__setitem__(self,key,count)
+        del self[key]
+        return key,count
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def clear(self):
+        dict.clear(self)
+        self._buckets = {}
+        self._head = self._tail = None
+
+    def most_common(self,n=None):
+        def items():
+            bucket = self._head
+            while bucket is not None:
+                for key in bucket.keys:
+                    yield key,bucket.count
+                bucket = bucket.next
+        return list(items() if n is None else islice(items(),max(n,0)))
+
+
+live = LiveCounter(words)
+live.most_common(3)             # [('eyes', 8), ('the', 5), ('look', 4)]
+live.update(morewords)
+live['eyes'] += 1
+
+
+def bench_live_counter(nwords=2*10**5,vocabulary=10**5,batch=100,k=10):
+    '''update(batch) + most_common(k) per batch: Counter vs LiveCounter'''
+    rnd = random.Random(0)
+    weights = [1/(i+1) for i in range(vocabulary)]
+    stream = rnd.choices(range(vocabulary),weights,k=nwords)
+    batches = [stream[i:i+batch] for i in range(0,nwords,batch)]
+    for cls in (Counter,LiveCounter):
+        counts = cls()
+        t0 = time.perf_counter()
+        for b in batches:
+            counts.update(b)
+            top = counts.most_common(k)
+        t = time.perf_counter() - t0
+        print('{:12s} {:.3f}s  ({:.0f} refreshes/s)'.format(cls.__name__,t,len(batches)/t))
+    assert [n for _,n in top] == [n for _,n in Counter(stream).most_common(k)]
+
 
 
 
@@ -328,6 +2771,115 @@ itemgetter('fname')(rows[1])
 sort_by_fname_ = sorted(rows, key=itemgetter('fname'))
 sort_by_fname_uid_ = sorted(rows, key=itemgetter('fname','uid'))
 
+'''
+For millions of records the key function runs once per record, but the sort then
+compares key tuples field by field, in Python. sort_records() reads each field once
+into a NumPy column and sorts the columns with np.lexsort, which is stable:
+    numbers are sorted as they are, descending ones negated (~x for ints);
+    anything else is replaced by its rank among the distinct values, sorted the same way;
+    a field holding None also gets a 0/1 "is None" column, checked before its values.
+'''
+
+def _typed(values):
+    # 1-D array when every value is a str, every one bytes, every one an int that
+    # fits int64, or every one a float; None otherwise, so mixed columns are compared
+    # by Python as sorted() would (np.array would make [10, 'a'] strings, and
+    # [2**60 + 1, 0.5] floats)
+    if not values:
+        return np.empty(0)
+    types = set(map(type,values))
+    kind = {str: 'U',bytes: 'S',bool: 'b',int: 'i',float: 'f'}.get(types.pop()) if len(types) == 1 else None
+    if kind is None:
+        return None
+    try:
+        col = np.array(values)
+    except OverflowError:
+        return None
+    return col if col.ndim == 1 and col.dtype.kind == kind else None
+
+def _sort_key(values,descending):
+    # (array whose ascending order is the wanted order of values, None mask or None)
+    missing = None
+    col = _typed(values)
+    if col is None:
+        col = np.empty(len(values),dtype=object)
+        for i,value in enumerate(values):
+            col[i] = value
+        missing = np.equal(col,None)
+        if missing.any():
+            col[missing] = col[~missing][0] if not missing.all() else 0
+        else:
+            missing = None
+        values = col.tolist()
+        typed = _typed(values)
+        if typed is not None:
+            col = typed
+    if col.dtype.kind == 'f':
+        return (-col if descending else col),missing
+    if col.dtype.kind == 'i':
+        return (~col if descending else col),missing
+    try:
+        distinct = set(values)
+    except TypeError:           # unhashable values
+        distinct = values
+    if len(distinct) <= len(values) // 4:
+        # Few distinct values: rank them with a dict rather than sorting them all
+        rank = {value: i for i,value in enumerate(sorted(distinct))}
+        ranks = np.fromiter(map(rank.__getitem__,values),dtype=np.int64,count=len(values))
+    else:
+        ranks = np.unique(col,return_inverse=True)[1].ravel()
+    return (-ranks if descending else ranks),missing
+
+def sort_records(records,fields,descending=False,nones='last',getter=itemgetter,return_index=False):
+    '''
+    Stable multi-field sort of a sequence of records.
+    fields: a field, or a list of them, read with getter(field): itemgetter for
+    dicts and tuples, attrgetter for objects. descending: a bool, or one per field.
+    nones: 'first' or 'last', in either direction.
+    Returns the sorted records, or the permutation as an array if return_index.
+    '''
+    if not isinstance(fields,(list,tuple)):
+        fields = [fields]
+    if isinstance(descending,bool):
+        descending = [descending]*len(fields)
+    if len(descending) != len(fields) or nones not in ('first','last'):
+        raise ValueError('need one descending flag per field, and nones first or last')
+    keys = []
+    for field,desc in zip(reversed(fields),reversed(descending)):      # last key is primary
+        key,missing = _sort_key(list(map(getter(field),records)),desc)
+        keys.append(key)
+        if missing is not None:
+            keys.append(~missing if nones == 'first' else missing)
+    order = np.lexsort(keys) if keys else np.arange(len(records))
+    if return_index:
+        return order
+    return list(map(records.__getitem__,order.tolist()))
+
+sort_by_fname_uid_np = sort_records(rows,['fname','uid'])
+by_lname_newest_first = sort_records(rows,['lname','uid'],descending=[False,True])
+
+
+def bench_sort_records(n=10**6):
+    '''sorted(key=itemgetter(...)) vs sort_records()'''
+    rnd = random.Random(0)
+    names = ['name{}'.format(i) for i in range(1000)]
+    records = [{'fname': rnd.choice(names),'uid': rnd.randrange(10**9),
+                'score': rnd.random() if rnd.random() < 0.9 else None} for _ in range(n)]
+    t0 = time.perf_counter()
+    expected = sorted(records,key=itemgetter('fname','uid'))
+    t1 = time.perf_counter()
+    got = sort_records(records,['fname','uid'])
+    t2 = time.perf_counter()
+    assert all(a is b for a,b in zip(got,expected))
+    print('{} records: sorted {:.2f}s  sort_records {:.2f}s  ({:.1f}x)'.format(n,t1-t0,t2-t1,(t1-t0)/(t2-t1)))
+    t0 = time.perf_counter()
+    expected = sorted(records,key=lambda r: (r['score'] is None,-r['score'] if r['score'] is not None else 0))
+    t1 = time.perf_counter()
+    got = sort_records(records,'score',descending=True)
+    t2 = time.perf_counter()
+    assert all(a is b for a,b in zip(got,expected))
+    print('  score desc, None last: sorted {:.2f}s  sort_records {:.2f}s'.format(t1-t0,t2-t1))
+
 
 
 
@@ -351,6 +2903,7 @@ sorted(users, key=lambda u: u.user_id)
 
 from operator import attrgetter
 sorted(users, key=attrgetter('user_id'))
+sort_records(users,'user_id',getter=attrgetter)
 
 
 
@@ -395,6 +2948,307 @@ from collections import defaultdict
 rows_by_date = defaultdict(list)
 for row in rows:
     rows_by_date[row['date']].append(row)
+
+'''
+Both need every row in memory. external_sort() sorts in runs: it reads as many
+items as fit in the memory budget, sorts them and spills them to a temp file as
+pickled batches. The runs are then merged lazily with heapq.merge() (recipe 4.15),
+which is stable, so the result is what sorted() would give. The runs can be sorted
+in a process pool (key must then be picklable, e.g. itemgetter). With more runs than
+fan_in, groups of runs are first merged into longer runs, to bound the open files.
+The output is sorted by key, so it feeds groupby() directly.
+'''
+
+def _write_batches(items,spilldir,batch=1024):
+    fd,filename = tempfile.mkstemp(suffix='.run',dir=spilldir)
+    with os.fdopen(fd,'wb') as f:
+        buf = []
+        for item in items:
+            buf.append(item)
+            if len(buf) >= batch:
+                pickle.dump(buf,f,pickle.HIGHEST_PROTOCOL)
+                buf = []
+        if buf:
+            pickle.dump(buf,f,pickle.HIGHEST_PROTOCOL)
+    return filename
+
+def _write_run(chunk,key,reverse,spilldir):
+    chunk.sort(key=key,reverse=reverse)
+    return _write_batches(chunk,spilldir)
+
+def _read_run(filename):
+    with open(filename,'rb') as f:
+        yield from _unspill(f)
+
+def external_sort(items,key=None,reverse=False,memory=1<<28,workers=1,tmpdir=None,fan_in=128):
+    '''
+    Sorted iterator over picklable items, holding about memory bytes of them at a
+    time while sorting. With workers > 1 the runs are workers + 1 times smaller, so
+    the runs in flight and the one being read stay within memory too.
+    '''
+    items = iter(items)
+    sample = list(islice(items,1000))
+    if not sample:
+        return
+    # Unpickled objects take roughly 3x their pickled size
+    per_item = len(pickle.dumps(sample,pickle.HIGHEST_PROTOCOL)) / len(sample)
+    run_size = max(len(sample),int(memory / (3*per_item)))
+    chunk = sample + list(islice(items,run_size - len(sample)))
+    if len(chunk) < run_size:
+        yield from sorted(chunk,key=key,reverse=reverse)      # fits in memory
+        return
+    with tempfile.TemporaryDirectory(dir=tmpdir) as spilldir:
+        runs = []
+        if workers == 1:
+            while chunk:
+                runs.append(_write_run(chunk,key,reverse,spilldir))
+                chunk = list(islice(items,run_size))
+        else:
+            # workers runs in flight and the one being read share the budget
+            run_size = max(len(sample),run_size // (workers + 1))
+            chunk,rest = chunk[:run_size],chunk[run_size:]
+            with ProcessPoolExecutor(workers) as pool:
+                pending = deque()
+                while chunk:
+                    pending.append(pool.submit(_write_run,chunk,key,reverse,spilldir))
+                    if len(pending) >= workers:      # at most workers runs in flight
+                        runs.append(pending.popleft().result())
+                    if rest:
+                        chunk,rest = rest[:run_size],rest[run_size:]
+                    else:
+                        chunk = list(islice(items,run_size))
+                runs.extend(f.result() for f in pending)
+        while len(runs) > fan_in:
+            merged = []
+            for i in range(0,len(runs),fan_in):
+                group = runs[i:i+fan_in]
+                merged.append(_write_batches(heapq.merge(*map(_read_run,group),key=key,reverse=reverse),
+                                             spilldir))
+                for filename in group:
+                    os.remove(filename)
+            runs = merged
+        yield from heapq.merge(*map(_read_run,runs),key=key,reverse=reverse)
+
+'''
+for date,items in groupby(external_sort(rows,key=itemgetter('date')),key=itemgetter('date')):
+    print(date,len(list(items)))
+'''
+
+
+def bench_external_sort(n=10**6,runs=10,workers=None):
+    '''sorted() vs external_sort() with a budget that makes about runs runs'''
+    rnd = random.Random(0)
+    records = [{'date': '{:02d}/{:02d}/2012'.format(rnd.randrange(1,13),rnd.randrange(1,29)),
+                'id': i} for i in range(n)]
+    per_item = len(pickle.dumps(records[:1000],pickle.HIGHEST_PROTOCOL)) / 1000
+    memory = int(3*per_item*n/runs)
+    t0 = time.perf_counter()
+    expected = sorted(records,key=itemgetter('date'))
+    t1 = time.perf_counter()
+    print('{} records: sorted {:.2f}s'.format(n,t1-t0))
+    for w in sorted({1,workers or os.cpu_count()}):
+        t1 = time.perf_counter()
+        got = list(external_sort(records,key=itemgetter('date'),memory=memory,workers=w))
+        t2 = time.perf_counter()
+        assert got == expected
+        print('  external_sort, {} runs, {} workers: {:.2f}s'.format(runs,w,t2-t1))
+
+
+'''
+Often only aggregates per group are wanted, not the rows. GroupBy keeps one small
+state per group instead:
+    aggs = {'n': ('count',None), 'total': ('sum','amount'), 'avg': ('mean','amount')}
+Functions are count, sum, min, max and mean; the field is read with itemgetter, or
+is a callable. None values are skipped, as in SQL. update() takes rows one by one;
+update_arrays() takes a batch of NumPy columns, reduces it per group with
+np.unique and ufunc.reduceat, and only then merges one state per group.
+With max_groups set, the states are spilled to hash partitions (_spill() from 1.9)
+whenever there are more groups; results() then merges one partition at a time.
+Results come out as (key, {name: value}) in no particular order.
+'''
+
+_AGGREGATES = ('count','sum','min','max','mean')
+
+class GroupBy(object):
+    '''Per-group aggregates over a stream of rows, key(row) -> group; spills past max_groups'''
+    def __init__(self,aggs,key=None,max_groups=None,partitions=64,tmpdir=None):
+        self.key = key
+        self.names = list(aggs)
+        self.funcs = []
+        self.getters = []
+        for name,(func,field) in aggs.items():
+            if func not in _AGGREGATES:
+                raise ValueError('{}: unknown aggregate {!r}'.format(name,func))
+            self.funcs.append(func)
+            self.getters.append(field if field is None or callable(field) else itemgetter(field))
+        self.max_groups = max_groups
+        self.partitions = partitions
+        self.tmpdir = tmpdir
+        self.states = {}
+        self.parts = None
+
+    def _new(self):
+        return [[0,0] if func == 'mean' else (0 if func in ('count','sum') else None)
+                for func in self.funcs]
+
+    def _merge(self,key,other):
+        state = self.states.get(key)
+        if state is None:
+            self.states[key] = other
+            return
+        for i,func in enumerate(self.funcs):
+            a,b = state[i],other[i]
+            if func == 'mean':
+                a[0] += b[0]
+                a[1] += b[1]
+            elif func in ('count','sum'):
+                state[i] = a + b
+            elif a is None or (b is not None and (b < a if func == 'min' else b > a)):
+                state[i] = b
+
+    def _spill_states(self):
+        if self.parts is None:
+            self.parts = [tempfile.TemporaryFile(dir=self.tmpdir) for _ in range(self.partitions)]
+        for f in self.parts:
+            f.seek(0,2)             # _spill() rewinds the files when it is done
+        _spill(self.states.items(),self.parts)
+        self.states = {}
+
+    def update(self,rows):
+        '''rows: records for key() and the fields in aggs'''
+        key,states = self.key,self.states
+        if key is None:
+            raise ValueError('update() needs GroupBy(key=...); update_arrays() takes the keys')
+        specs = {func: [(i,get) for i,(f,get) in enumerate(zip(self.funcs,self.getters)) if f == func]
+                 for func in _AGGREGATES}
+        counts = [i for i,_ in specs['count']]
+        sums,means,mins,maxs = specs['sum'],specs['mean'],specs['min'],specs['max']
+        for row in rows:
+            k = key(row)
+            state = states.get(k)
+            if state is None:
+                if self.max_groups is not None and len(states) >= self.max_groups:
+                    self._spill_states()
+                    states = self.states
+                state = states[k] = self._new()
+            for i in counts:
+                state[i] += 1
+            for i,get in sums:
+                value = get(row)
+                if value is not None:
+                    state[i] += value
+            for i,get in means:
+                value = get(row)
+                if value is not None:
+                    s = state[i]
+                    s[0] += value
+                    s[1] += 1
+            for i,get in mins:
+                value = get(row)
+                if value is not None and (state[i] is None or value < state[i]):
+                    state[i] = value
+            for i,get in maxs:
+                value = get(row)
+                if value is not None and (state[i] is None or value > state[i]):
+                    state[i] = value
+
+    def update_arrays(self,keys,columns):
+        '''keys: array of group keys; columns: {field: array}, for the fields in aggs'''
+        keys = np.asarray(keys)
+        if len(keys) == 0:
+            return
+        groups,inverse = np.unique(keys,return_inverse=True)
+        inverse = inverse.ravel()
+        order = np.argsort(inverse,kind='stable')
+        counts = np.bincount(inverse,minlength=len(groups))
+        starts = np.concatenate(([0],np.cumsum(counts)[:-1]))
+        partial = []
+        for func,field in zip(self.funcs,self.getters):
+            if func == 'count':
+                partial.append(counts)
+                continue
+            values = np.asarray(field(columns) if callable(field) else columns[field])[order]
+            if func in ('sum','mean'):
+                sums = np.add.reduceat(values,starts)
+                partial.append(sums if func == 'sum' else (sums,counts))
+            else:
+                partial.append((np.minimum if func == 'min' else np.maximum).reduceat(values,starts))
+        columns = [zip(p[0].tolist(),p[1].tolist()) if func == 'mean' else p.tolist()
+                   for func,p in zip(self.funcs,partial)]
+        for k,state in zip(groups.tolist(),zip(*columns)):
+            self._merge(k,[list(s) if func == 'mean' else s for func,s in zip(self.funcs,state)])
+        if self.max_groups is not None and len(self.states) > self.max_groups:
+            self._spill_states()
+
+    def _final(self,state):
+        return {name: ((s[0] / s[1] if s[1] else None) if func == 'mean' else s)
+                for name,func,s in zip(self.names,self.funcs,state)}
+
+    def results(self):
+        '''Yield (key, {name: value}); spilled groups are merged one partition at a time'''
+        if self.parts is None:
+            for k,state in self.states.items():
+                yield k,self._final(state)
+            return
+        self._spill_states()
+        parts,self.parts = self.parts,None
+        try:
+            for f in parts:
+                self.states = {}
+                for k,state in _unspill(f):
+                    self._merge(k,state)
+                for k,state in self.states.items():
+                    yield k,self._final(state)
+                f.close()
+        finally:
+            for f in parts:
+                f.close()
+            self.states = {}
+
+
+by_date = GroupBy({'n': ('count',None),'first': ('min','address')},key=itemgetter('date'))
+by_date.update(rows)
+dict(by_date.results())         # {'07/01/2012': {'n': 2, 'first': '4801 N BROADWAY'}, ...}
+
+
+def bench_group_by(n=10**6,ngroups=10**4):
+    '''per-group count/sum/mean/max: defaultdict(list) vs GroupBy rows vs GroupBy arrays'''
+    rnd = random.Random(0)
+    keys = [rnd.randrange(ngroups) for _ in range(n)]
+    amounts = [rnd.random() for _ in range(n)]
+    records = [{'date': k,'amount': a} for k,a in zip(keys,amounts)]
+    aggs = {'n': ('count',None),'total': ('sum','amount'),'avg': ('mean','amount'),'hi': ('max','amount')}
+    t0 = time.perf_counter()
+    groups = defaultdict(list)
+    for r in records:
+        groups[r['date']].append(r)
+    expected = {}
+    for k,rs in groups.items():
+        values = [r['amount'] for r in rs]
+        expected[k] = {'n': len(values),'total': sum(values),'avg': sum(values)/len(values),'hi': max(values)}
+    t1 = time.perf_counter()
+    g = GroupBy(aggs,key=itemgetter('date'))
+    g.update(records)
+    got = dict(g.results())
+    rows_time = time.perf_counter() - t1
+    batches = [(np.array(keys[i:i+(1<<16)]),{'amount': np.array(amounts[i:i+(1<<16)])})
+               for i in range(0,n,1<<16)]
+    t2 = time.perf_counter()
+    a = GroupBy(aggs)
+    for batch_keys,batch_columns in batches:
+        a.update_arrays(batch_keys,batch_columns)
+    got_arrays = dict(a.results())
+    t3 = time.perf_counter()
+    s = GroupBy(aggs,key=itemgetter('date'),max_groups=ngroups//4)
+    s.update(records)
+    got_spilled = dict(s.results())
+    t4 = time.perf_counter()
+    for result in (got,got_arrays,got_spilled):
+        assert result.keys() == expected.keys()
+        assert all(abs(result[k][f] - expected[k][f]) <= 1e-9*abs(expected[k][f]) + 1e-12
+                   for k in expected for f in aggs)
+    print('{} rows, {} groups: defaultdict(list) {:.2f}s  GroupBy {:.2f}s  arrays {:.2f}s  spilling {:.2f}s'.format(
+          n,ngroups,t1-t0,rows_time,t3-t2,t4-t3))
         
     
     
@@ -439,6 +3293,191 @@ counts = [ 0, 3, 10, 4, 1, 7, 6, 1]
 more5 = [n>5 for n in counts]
 list(compress(addresses,more5))
 
+'''
+Over a whole column, the per-value Python call (int() in a try, or n>5 for compress)
+is the cost. The masks below take a NumPy column of str or bytes ('U' or 'S'; lists
+are converted) and test every value at once:
+    int_mask(), float_mask(): the text int()/float() would accept, checked by running a
+        small state machine over the character positions, one NumPy step per position
+        for all rows. ASCII only: other Unicode digits and spaces are rejected.
+    range_mask(): lo <= value <= hi for numbers, or for text that float_mask() accepts.
+    member_mask(): np.isin() against a set of values.
+select() then applies a mask to an array (a boolean index) or to a list.
+'''
+
+# Character classes, and one transition row per state: -1 fails for good
+_OTHER,_SPACE,_SIGN,_DIGIT,_UNDERSCORE,_PAD,_DOT,_EXP = range(8)
+_CLASSES = np.zeros(256,dtype=np.intp)
+_CLASSES[[9,10,11,12,13,32]] = _SPACE
+_CLASSES[[43,45]] = _SIGN
+_CLASSES[48:58] = _DIGIT
+_CLASSES[95] = _UNDERSCORE
+_CLASSES[0] = _PAD             # numpy pads short values with NUL
+_CLASSES[46] = _DOT
+_CLASSES[[69,101]] = _EXP
+
+def _machine(transitions,accept):
+    # Next states are stored premultiplied by the number of classes, so a step is
+    # table[state + cls]; the extra last state absorbs every failure.
+    fail = len(transitions)
+    table = np.full((fail+1,8),fail*8,dtype=np.intp)
+    for state,moves in enumerate(transitions):
+        for cls,target in moves.items():
+            table[state,cls] = target*8
+    accepting = np.zeros((fail+1)*8,dtype=bool)
+    accepting[[s*8 for s in accept]] = True
+    return table.ravel(),accepting
+
+# ws* sign? digit (_? digit)* ws*
+_INT = _machine([
+    {_SPACE: 0,_SIGN: 1,_DIGIT: 2},                       # 0 leading blanks
+    {_DIGIT: 2},                                          # 1 sign
+    {_DIGIT: 2,_UNDERSCORE: 3,_SPACE: 4,_PAD: 5},         # 2 digits
+    {_DIGIT: 2},                                          # 3 underscore
+    {_SPACE: 4,_PAD: 5},                                  # 4 trailing blanks
+    {_PAD: 5},                                            # 5 padding
+],accept=(2,4,5))
+
+# ws* sign? (digits (. digits?)? | . digits) (e sign? digits)? ws*, digits as above
+_FLOAT = _machine([
+    {_SPACE: 0,_SIGN: 1,_DIGIT: 2,_DOT: 3},                           # 0 leading blanks
+    {_DIGIT: 2,_DOT: 3},                                              # 1 sign
+    {_DIGIT: 2,_UNDERSCORE: 4,_DOT: 5,_EXP: 6,_SPACE: 9,_PAD: 10},    # 2 integer part
+    {_DIGIT: 7},                                                      # 3 leading point
+    {_DIGIT: 2},                                                      # 4 underscore
+    {_DIGIT: 7,_EXP: 6,_SPACE: 9,_PAD: 10},                           # 5 point after digits
+    {_SIGN: 11,_DIGIT: 12},                                           # 6 e
+    {_DIGIT: 7,_UNDERSCORE: 8,_EXP: 6,_SPACE: 9,_PAD: 10},            # 7 fraction
+    {_DIGIT: 7},                                                      # 8 underscore
+    {_SPACE: 9,_PAD: 10},                                             # 9 trailing blanks
+    {_PAD: 10},                                                       # 10 padding
+    {_DIGIT: 12},                                                     # 11 exponent sign
+    {_DIGIT: 12,_UNDERSCORE: 13,_SPACE: 9,_PAD: 10},                  # 12 exponent
+    {_DIGIT: 12},                                                     # 13 underscore
+],accept=(2,5,7,9,10,12))
+
+def _text_column(values):
+    col = values if isinstance(values,np.ndarray) else np.array(values)
+    if col.dtype.kind not in 'SU':
+        raise TypeError('need a column of str or bytes, got {}'.format(col.dtype))
+    return col
+
+def _chars(col):
+    # (n, width) character codes of a 'S' or 'U' column
+    width = col.dtype.itemsize // (4 if col.dtype.kind == 'U' else 1)
+    chars = np.ascontiguousarray(col).view(np.uint32 if col.dtype.kind == 'U' else np.uint8)
+    return chars.reshape(len(col),width)
+
+def _run(machine,col):
+    table,accepting = machine
+    chars = _chars(_text_column(col))
+    state = np.zeros(len(chars),dtype=np.intp)
+    # one step per character position; code points above 255 are 'other'
+    for position in _CLASSES[np.minimum(chars.T,255)]:
+        state = table[state + position]
+    return accepting[state]
+
+def int_mask(col):
+    '''True where int(value) would succeed'''
+    return _run(_INT,col)
+
+def float_mask(col):
+    '''True where float(value) would succeed'''
+    col = _text_column(col)
+    mask = _run(_FLOAT,col)
+    # inf, infinity and nan in any case: only rows that failed and hold an n are left
+    chars = _chars(col)
+    rest = np.flatnonzero(~mask & ((chars | 32) == 110).any(axis=1))
+    if len(rest):
+        # compared in the column's own kind: bytes need not decode as ASCII
+        words,plus,minus = ['inf','infinity','nan'],'+','-'
+        if col.dtype.kind == 'S':
+            words,plus,minus = [w.encode() for w in words],b'+',b'-'
+        stripped = np.char.strip(col[rest])
+        text = np.char.lower(stripped)
+        signed = np.char.startswith(text,plus) | np.char.startswith(text,minus)
+        text[signed] = np.char.lstrip(text[signed],plus + minus)
+        mask[rest] = np.isin(text,words) & (np.char.str_len(text) + signed == np.char.str_len(stripped))
+    return mask
+
+def range_mask(col,lo=None,hi=None):
+    '''lo <= value <= hi (None: unbounded); text that is not a number is out of range'''
+    col = col if isinstance(col,np.ndarray) else np.array(col)
+    if col.dtype.kind in 'SU':
+        valid = float_mask(col)
+        values = np.full(len(col),np.nan)
+        values[valid] = col[valid].astype(np.float64)
+    else:
+        valid,values = np.ones(len(col),dtype=bool),col
+    if lo is not None:
+        valid &= values >= lo
+    if hi is not None:
+        valid &= values <= hi
+    return valid
+
+def member_mask(col,values):
+    '''True where the value is one of values'''
+    col = col if isinstance(col,np.ndarray) else np.array(col)
+    values = np.array(list(values))
+    if col.dtype.kind == 'S' and values.dtype.kind == 'U':
+        values = np.char.encode(values)
+    elif col.dtype.kind == 'U' and values.dtype.kind == 'S':
+        values = np.char.decode(values)
+    return np.isin(col,values)
+
+def select(data,mask):
+    '''The items of data where mask is True: a boolean index for arrays, else a list'''
+    if isinstance(data,np.ndarray):
+        return data[mask]
+    return list(map(data.__getitem__,np.flatnonzero(mask).tolist()))
+
+select(vals,int_mask(vals))                         # ['1', '2', '-3', '4', '5']
+select(addresses,np.array(counts) > 5)
+select(vals,range_mask(vals,0,3))                   # ['1', '2']
+float_mask(np.array([b'\xffn',b'1.5',b'-inf']))     # [False, True, True]: bytes need not be ASCII
+
+
+def bench_filter(n=10**6):
+    '''filter(is_int)/compress() from the recipe vs the masks'''
+    rnd = random.Random(0)
+    pool = ['1','-23','456','N/A','-','3.25','  7 ','1e5','abc','']
+    text = [rnd.choice(pool) for _ in range(n)]
+    t0 = time.perf_counter()
+    expected = list(filter(is_int,text))
+    t1 = time.perf_counter()
+    col = np.array(text)
+    t2 = time.perf_counter()
+    got = select(col,int_mask(col))
+    t3 = time.perf_counter()
+    assert got.tolist() == expected
+    print('{} values: filter(is_int) {:.3f}s  int_mask {:.3f}s  (+{:.3f}s to build the column)'.format(
+          n,t1-t0,t3-t2,t2-t1))
+    def is_float(val):
+        try:
+            float(val)
+            return True
+        except ValueError:
+            return False
+    t0 = time.perf_counter()
+    expected = list(filter(is_float,text))
+    t1 = time.perf_counter()
+    got = select(col,float_mask(col))
+    t2 = time.perf_counter()
+    assert got.tolist() == expected
+    print('  filter(is_float) {:.3f}s  float_mask {:.3f}s'.format(t1-t0,t2-t1))
+    raw = np.array([v.encode() for v in text[:10**4]] + [b'\xffn',b'-inf',b'NaN\xe9',b' nan ',b'\xff1'])
+    assert select(raw,float_mask(raw)).tolist() == list(filter(is_float,raw.tolist()))
+    numbers = [rnd.randrange(20) for _ in range(n)]
+    t0 = time.perf_counter()
+    expected = list(compress(text,[x > 5 for x in numbers]))
+    t1 = time.perf_counter()
+    array = np.array(numbers)
+    t2 = time.perf_counter()
+    got = select(col,array > 5)
+    t3 = time.perf_counter()
+    assert got.tolist() == expected
+    print('  compress() {:.3f}s  mask {:.3f}s  (+{:.3f}s to build the column)'.format(t1-t0,t3-t2,t2-t1))
+
 
 
 
@@ -483,6 +3522,182 @@ def dict_to_stock(s):
 
 dict_to_stock({'name': 'ACME', 'shares': 100, 'price': 123.45})
 
+'''
+A namedtuple per record costs a tuple plus the objects it points to, and
+_replace(**s) builds a dict and two tuples each time. RecordBatch keeps N records as
+one NumPy array per field (typed where a dtype is given, object otherwise). The
+fields and their defaults come from a prototype namedtuple, as with stock_prototype:
+    batch.price                  the whole column
+    batch[i]                     a row view: __slots__, just (batch, index)
+    batch._replace(price=...)    a new batch; a value or a column per field
+from_dicts() builds the columns in one pass per field, like dict_to_stock() would.
+'''
+
+from collections.abc import Sequence
+from operator import methodcaller
+
+class _Row(object):
+    '''View of one record of a RecordBatch; fields are read from the columns'''
+    __slots__ = ('_batch','_index')
+    def __init__(self,batch,index):
+        self._batch = batch
+        self._index = index
+
+    def __iter__(self):
+        i = self._index
+        return (col.item(i) for col in self._batch._columns)
+
+    def __getitem__(self,position):
+        return tuple(self)[position]
+
+    def __len__(self):
+        return len(self._batch._fields)
+
+    def __eq__(self,other):
+        return tuple(self) == tuple(other)
+
+    def __repr__(self):
+        return '{}({})'.format(self._batch.prototype.__class__.__name__,
+                               ', '.join('{}={!r}'.format(f,v) for f,v in zip(self._batch._fields,self)))
+
+    def _asdict(self):
+        return dict(zip(self._batch._fields,self))
+
+    def _replace(self,**kwargs):
+        return self._batch.prototype._make(self)._replace(**kwargs)
+
+
+class RecordBatch(object):
+    '''Subclass with prototype = a namedtuple instance and dtypes = {field: dtype}'''
+    prototype = None
+    dtypes = {}
+
+    def __init_subclass__(cls,**kwargs):
+        super().__init_subclass__(**kwargs)
+        cls._fields = cls.prototype._fields
+        row = type(cls.__name__ + 'Row',(_Row,),{'__slots__': ()})
+        for position,field in enumerate(cls._fields):
+            setattr(row,field,property(lambda self,p=position: self._batch._columns[p].item(self._index)))
+            setattr(cls,field,property(lambda self,p=position: self._columns[p]))
+        cls._row = row
+
+    def __init__(self,columns):
+        '''columns: one sequence per field, in field order'''
+        self._columns = [np.asarray(col,dtype=self.dtypes.get(field,object))
+                         for field,col in zip(self._fields,columns)]
+        if len(self._columns) != len(self._fields) or len({len(c) for c in self._columns}) > 1:
+            raise ValueError('need one column per field, all of the same length')
+
+    @classmethod
+    def from_dicts(cls,dicts):
+        '''Bulk dict_to_stock(): missing fields take the prototype's value'''
+        dicts = dicts if isinstance(dicts,list) else list(dicts)
+        unknown = set().union(*dicts) - set(cls._fields)
+        if unknown:
+            raise ValueError('Got unexpected field names: {!r}'.format(sorted(unknown)))
+        columns = []
+        for field,default in zip(cls._fields,cls.prototype):
+            dtype = cls.dtypes.get(field,object)
+            values = map(methodcaller('get',field,default),dicts)
+            if dtype is object:
+                col = np.empty(len(dicts),dtype=object)
+                col[:] = list(values)
+            else:
+                col = np.fromiter(values,dtype=dtype,count=len(dicts))
+            columns.append(col)
+        return cls(columns)
+
+    @classmethod
+    def from_records(cls,records):
+        return cls([list(col) for col in zip(*records)] if records else [[] for _ in cls._fields])
+
+    def __len__(self):
+        return len(self._columns[0])
+
+    def __getitem__(self,index):
+        '''A row view for an int; a new batch for a slice, mask or index array'''
+        if isinstance(index,(int,np.integer)):
+            if index < 0:
+                index += len(self)
+            if not 0 <= index < len(self):
+                raise IndexError('record index out of range')
+            return self._row(self,index)
+        return type(self)([col[index] for col in self._columns])
+
+    def __iter__(self):
+        row = self._row
+        return (row(self,i) for i in range(len(self)))
+
+    def _replace(self,**kwargs):
+        '''
+        New batch with whole fields replaced, by one value or by a column: an array
+        or any other sequence except str and bytes, of length len(self)
+        '''
+        unknown = kwargs.keys() - set(self._fields)
+        if unknown:
+            raise ValueError('Got unexpected field names: {!r}'.format(sorted(unknown)))
+        columns = []
+        for field,col in zip(self._fields,self._columns):
+            if field in kwargs:
+                value = kwargs[field]
+                new = np.empty(len(col),dtype=col.dtype)
+                if isinstance(value,(str,bytes)) or not isinstance(value,(Sequence,np.ndarray)):
+                    new.fill(value)
+                elif len(value) != len(col):
+                    raise ValueError('{}: need one value or {} of them, got {}'.format(field,len(col),len(value)))
+                elif col.dtype == object:
+                    new[:] = np.fromiter(value,dtype=object,count=len(col))     # items may be sequences
+                else:
+                    new[:] = value
+                col = new
+            columns.append(col)
+        return type(self)(columns)
+
+    def tolist(self):
+        '''The records as prototype namedtuples'''
+        return list(map(self.prototype._make,zip(*(col.tolist() for col in self._columns))))
+
+    def nbytes(self):
+        '''Bytes held by the arrays (object columns count their pointers only)'''
+        return sum(col.nbytes for col in self._columns)
+
+
+
+class StockBatch(RecordBatch):
+    prototype = stock_prototype
+    dtypes = {'shares': np.int64,'price': np.float64}
+
+stocks = StockBatch.from_dicts([{'name': 'ACME', 'shares': 100, 'price': 123.45},
+                                {'name': 'AA', 'shares': 50, 'price': 39.2}])
+stocks[0].price                               # 123.45
+stocks = stocks._replace(price=stocks.price * 1.1,date='2012-07-01')
+
+
+def bench_record_batch(n=10**6):
+    '''memory per record and conversion throughput: dict_to_stock() vs StockBatch'''
+    import tracemalloc
+    rnd = random.Random(0)
+    dicts = [{'name': rnd.choice(['ACME','AA','IBM','HPQ']),'shares': rnd.randrange(1000),
+              'price': rnd.random()*100} for _ in range(n)]
+    for name,build in (('namedtuple',lambda: [dict_to_stock(d) for d in dicts]),
+                       ('StockBatch',lambda: StockBatch.from_dicts(dicts))):
+        tracemalloc.start()
+        records = build()
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del records
+        t0 = time.perf_counter()
+        records = build()
+        t1 = time.perf_counter()
+        if name == 'namedtuple':
+            records = [s._replace(price=s.price*1.1) for s in records]
+        else:
+            records = records._replace(price=records.price*1.1)
+        t2 = time.perf_counter()
+        print('{:10s}  {:.0f} bytes/record  build {:.2f} M records/s  _replace {:.2f} M records/s'.format(
+              name,size/n,n/(t1-t0)/1e6,n/(t2-t1)/1e6))
+        del records
+
 
 
 
@@ -504,6 +3719,249 @@ min_shares = min(s['shares'] for s in portfolio)
 min_shares = min(portfolio,key=lambda s:s['shares'])
 
 
+'''
+Each of those generator expressions is a full pass over the data; min, max, sum,
+mean, variance and percentiles of several fields make a dozen passes. StreamStats
+makes one: update() gathers the fields of each row into per-field buffers, and
+every batch rows the buffers go through the NumPy path, update_arrays(), which
+also takes columns directly. Per field it keeps
+    Moments     count, sum, min, max, mean and variance (Chan's pairwise update)
+    KLLSketch   approximate quantiles in O(k) memory, rank error about 1.7/k
+Both merge, so workers can reduce their own share and the parent merges the
+states; parallel_stats() does that with a process pool. Fields are numeric
+(converted to float64); None and NaN are skipped.
+'''
+
+class Moments(object):
+    __slots__ = ('count','total','mean','m2','min','max')
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.min = math.inf
+        self.max = -math.inf
+
+    def _combine(self,count,total,mean,m2,lo,hi):
+        n = self.count + count
+        delta = mean - self.mean
+        self.m2 += m2 + delta*delta*self.count*count/n
+        self.mean += delta*count/n
+        self.count = n
+        self.total += total
+        self.min = min(self.min,lo)
+        self.max = max(self.max,hi)
+
+    def add(self,value):
+        self._combine(1,value,value,0.0,value,value)
+
+    def add_array(self,values):
+        if len(values):
+            mean = values.mean()
+            self._combine(len(values),float(values.sum()),float(mean),float(np.square(values - mean).sum()),
+                          float(values.min()),float(values.max()))
+
+    def merge(self,other):
+        if other.count:
+            self._combine(other.count,other.total,other.mean,other.m2,other.min,other.max)
+
+    def variance(self,ddof=0):
+        return self.m2 / (self.count - ddof) if self.count > ddof else math.nan
+
+
+class KLLSketch(object):
+    '''Karnin-Lang-Liberty quantile sketch; level h items weigh 2**h'''
+    def __init__(self,k=256,c=2/3,seed=None):
+        self.k = k
+        self.c = c
+        self.levels = [np.empty(0)]
+        self.count = 0
+        self._pending = []          # add() values not yet in levels[0]
+        self._rng = random.Random(seed)
+        self._sizes()
+
+    def _sizes(self):
+        height = len(self.levels)
+        self.capacity = [max(2,int(math.ceil(self.k * self.c ** (height - h - 1)))) for h in range(height)]
+        self.max_size = sum(self.capacity)
+
+    def _compress(self):
+        if self._pending:
+            self.levels[0] = np.concatenate((self.levels[0],self._pending))
+            self._pending = []
+        while sum(map(len,self.levels)) >= self.max_size:
+            for h,level in enumerate(self.levels):
+                if len(level) >= self.capacity[h]:
+                    break
+            if h + 1 == len(self.levels):
+                self.levels.append(np.empty(0))
+                self._sizes()
+            items = np.sort(level)
+            odd = len(items) % 2
+            offset = self._rng.getrandbits(1)
+            self.levels[h + 1] = np.concatenate((self.levels[h + 1],items[offset:len(items) - odd:2]))
+            self.levels[h] = items[len(items) - odd:]
+
+    def add(self,value):
+        self._pending.append(value)
+        self.count += 1
+        if len(self._pending) >= self.capacity[0]:
+            self._compress()
+
+    def add_array(self,values):
+        self.levels[0] = np.concatenate((self.levels[0],values))
+        self.count += len(values)
+        self._compress()
+
+    def merge(self,other):
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+        self._sizes()
+        other._compress()
+        for h,items in enumerate(other.levels):
+            self.levels[h] = np.concatenate((self.levels[h],items))
+        self.count += other.count
+        self._compress()
+
+    def quantile(self,q):
+        '''Approximate q-quantile(s), q in [0, 1]; nan when empty'''
+        self._compress()
+        values = np.concatenate(self.levels)
+        if len(values) == 0:
+            return np.full(np.shape(q),math.nan)[()]
+        weights = np.concatenate([np.full(len(level),1 << h,dtype=np.int64)
+                                  for h,level in enumerate(self.levels)])
+        order = np.argsort(values,kind='stable')
+        cumulative = np.cumsum(weights[order])
+        ranks = np.ceil(np.asarray(q,dtype=float) * cumulative[-1]).clip(1,None)
+        return values[order][np.searchsorted(cumulative,ranks).clip(0,len(values) - 1)][()]
+
+
+class StreamStats(object):
+    def __init__(self,fields,quantiles=True,k=256,getter=itemgetter,batch=1<<16):
+        self.fields = list(fields)
+        self.getters = [getter(f) for f in self.fields]
+        self.moments = {f: Moments() for f in self.fields}
+        self.sketches = {f: KLLSketch(k) for f in self.fields} if quantiles else None
+        self.batch = batch
+
+    def update(self,rows):
+        '''One pass over rows; None values are skipped'''
+        buffers = [[] for _ in self.fields]
+        specs = [(get,buf.append) for get,buf in zip(self.getters,buffers)]
+        for rows in iter(lambda it=iter(rows): list(islice(it,self.batch)),[]):
+            for row in rows:
+                for get,append in specs:
+                    append(get(row))
+            self.update_arrays({f: np.array(buf,dtype=float) for f,buf in zip(self.fields,buffers)})
+            for buf in buffers:
+                buf.clear()
+
+    def update_arrays(self,columns):
+        '''columns: {field: array}; NaN values are skipped'''
+        for f in self.fields:
+            values = np.asarray(columns[f],dtype=float)
+            values = values[~np.isnan(values)]
+            self.moments[f].add_array(values)
+            if self.sketches is not None:
+                self.sketches[f].add_array(values)
+
+    def merge(self,other):
+        for f in self.fields:
+            self.moments[f].merge(other.moments[f])
+            if self.sketches is not None:
+                self.sketches[f].merge(other.sketches[f])
+        return self
+
+    def summary(self,percentiles=(0.5,0.9,0.99)):
+        '''{field: {'count', 'sum', 'min', 'max', 'mean', 'variance', 'p50', ...}}'''
+        result = {}
+        for f in self.fields:
+            m = self.moments[f]
+            empty = m.count == 0
+            stats = {'count': m.count,'sum': m.total,'min': math.nan if empty else m.min,
+                     'max': math.nan if empty else m.max,'mean': math.nan if empty else m.mean,
+                     'variance': m.variance()}
+            if self.sketches is not None:
+                qs = np.atleast_1d(self.sketches[f].quantile(percentiles))
+                stats.update(('p{:g}'.format(100*p),q) for p,q in zip(percentiles,qs.tolist()))
+            result[f] = stats
+        return result
+
+
+def _batch_stats(args):
+    fields,columns,kwargs = args
+    stats = StreamStats(fields,**kwargs)
+    stats.update_arrays(columns)
+    return stats
+
+def parallel_stats(batches,fields,workers=None,**kwargs):
+    '''
+    batches: iterable of {field: array}; each worker reduces whole batches. Only
+    2*workers batches are in flight, so a stream of them is not read ahead.
+    '''
+    workers = workers or os.cpu_count()
+    total = StreamStats(fields,**kwargs)
+    with ProcessPoolExecutor(workers) as pool:
+        pending = deque()
+        for columns in batches:
+            pending.append(pool.submit(_batch_stats,(fields,columns,kwargs)))
+            if len(pending) >= 2*workers:
+                total.merge(pending.popleft().result())
+        for f in pending:
+            total.merge(f.result())
+    return total
+
+
+stats = StreamStats(['shares'])
+stats.update(portfolio)
+stats.summary()     # {'shares': {'count': 4, 'sum': 210.0, 'min': 20.0, 'max': 75.0, 'mean': 52.5, ...}}
+
+
+def bench_stream_stats(n=10**6,workers=None):
+    '''six statistics of three fields: one generator pass each vs StreamStats'''
+    rnd = random.Random(0)
+    rows = [{'shares': rnd.randrange(1000),'price': rnd.lognormvariate(3,1),'fee': rnd.random()}
+            for _ in range(n)]
+    fields = ['shares','price','fee']
+    percentiles = (0.5,0.9,0.99)
+    t0 = time.perf_counter()
+    expected = {}
+    for f in fields:
+        total = sum(r[f] for r in rows)
+        mean = total / n
+        ordered = sorted(r[f] for r in rows)
+        expected[f] = {'count': n,'sum': total,'min': min(r[f] for r in rows),'max': max(r[f] for r in rows),
+                       'mean': mean,'variance': sum((r[f] - mean)**2 for r in rows) / n}
+        expected[f].update(('p{:g}'.format(100*p),ordered[max(0,math.ceil(p*n) - 1)]) for p in percentiles)
+    t1 = time.perf_counter()
+    stats = StreamStats(fields)
+    stats.update(rows)
+    got = stats.summary(percentiles)
+    t2 = time.perf_counter()
+    columns = {f: np.array([r[f] for r in rows],dtype=float) for f in fields}
+    batches = [{f: c[i:i+(1<<16)] for f,c in columns.items()} for i in range(0,n,1<<16)]
+    t3 = time.perf_counter()
+    arrays = StreamStats(fields)
+    for batch in batches:
+        arrays.update_arrays(batch)
+    got_arrays = arrays.summary(percentiles)
+    t4 = time.perf_counter()
+    got_parallel = parallel_stats(batches,fields,workers).summary(percentiles)
+    t5 = time.perf_counter()
+    for result in (got,got_arrays,got_parallel):
+        for f in fields:
+            ordered = np.sort(columns[f])
+            for s,value in result[f].items():
+                if s.startswith('p'):
+                    rank = np.searchsorted(ordered,value,side='right') / n
+                    assert abs(rank - float(s[1:])/100) < 0.02, (f,s,rank)
+                else:
+                    assert math.isclose(value,expected[f][s],rel_tol=1e-9), (f,s)
+    print('{} rows, 3 fields: generator passes {:.2f}s  StreamStats rows {:.2f}s  arrays {:.2f}s  parallel {:.2f}s'.format(
+          n,t1-t0,t2-t1,t4-t3,t5-t4))
+
+
 
 
 # 1.20 Combining multiple mapings into a single mapping
@@ -531,6 +3989,207 @@ values['x'] = 3
 
 values = values.parents   # Discard last mapping
 
+'''
+Each ChainMap lookup walks the maps in order, so a key that lives at the bottom of a
+30 level stack, or is missing, costs 30 dict probes. LayeredMap keeps a flat cache
+of what each key resolved to (misses included). The layers are Layer dicts that
+know which caches they feed, so a write to any layer drops only that key from the
+caches of every chain containing the layer. new_child() and parents share the layers
+as ChainMap does, so a write through a child's parent is seen by the child.
+Plain mappings passed in are copied into Layers; write to them through the chain
+or through chain.maps, which is a tuple so that its order stays what the cache saw.
+'''
+
+import weakref
+
+_ABSENT = object()
+
+class _Cache(dict):
+    '''Flat key -> value cache of one LayeredMap (weakly referenced by the layers)'''
+
+
+class Layer(dict):
+    '''dict that drops keys it writes from the caches of the chains it belongs to'''
+    def __init__(self,*args,**kwargs):
+        super().__init__(*args,**kwargs)
+        self._caches = {}           # id -> weakref to the _Cache of each chain
+
+    def _subscribe(self,cache):
+        caches = self._caches
+        caches[id(cache)] = weakref.ref(cache,lambda _,i=id(cache): caches.pop(i,None))
+
+    def _invalidate(self,key):
+        for ref in self._caches.values():
+            cache = ref()
+            if cache is not None:
+                cache.pop(key,None)
+
+    def __setitem__(self,key,value):
+        super().__setitem__(key,value)
+        self._invalidate(key)
+
+    def __delitem__(self,key):
+        super().__delitem__(key)
+        self._invalidate(key)
+
+    def pop(self,key,*default):
+        value = super().pop(key,*default)
+        self._invalidate(key)
+        return value
+
+    def popitem(self):
+        key,value = super().popitem()
+        self._invalidate(key)
+        return key,value
+
+    def setdefault(self,key,default=None):
+        if key not in self:
+            self[key] = default
+        return self[key]
+
+    def update(self,*args,**kwargs):
+        for key,value in dict(*args,**kwargs).items():
+            self[key] = value
+
+    def __ior__(self,other):
+        self.update(other)
+        return self
+
+    def clear(self):
+        super().clear()
+        for ref in self._caches.values():
+            cache = ref()
+            if cache is not None:
+                cache.clear()
+
+    def copy(self):
+        return Layer(self)
+
+
+class LayeredMap(MutableMapping):
+    '''ChainMap with a flattened lookup cache; writes go to maps[0]'''
+    def __init__(self,*maps):
+        self.maps = tuple(m if isinstance(m,Layer) else Layer(m) for m in maps) or (Layer(),)
+        self._cache = _Cache()
+        for m in self.maps:
+            m._subscribe(self._cache)
+
+    def _find(self,key):
+        for m in self.maps:
+            if key in m:
+                return m[key]
+        return _ABSENT
+
+    def __missing__(self,key):
+        raise KeyError(key)
+
+    def __getitem__(self,key):
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = self._find(key)
+        if value is _ABSENT:
+            return self.__missing__(key)
+        return value
+
+    def get(self,key,default=None):
+        try:
+            value = self._cache[key]
+        except KeyError:
+            value = self._cache[key] = self._find(key)
+        return default if value is _ABSENT else value
+
+    def __contains__(self,key):
+        return self.get(key,_ABSENT) is not _ABSENT
+
+    def __setitem__(self,key,value):
+        self.maps[0][key] = value
+        self._cache[key] = value
+
+    def __delitem__(self,key):
+        try:
+            del self.maps[0][key]
+        except KeyError:
+            raise KeyError('Key not found in the first mapping: {!r}'.format(key))
+
+    def __len__(self):
+        return len(set().union(*self.maps))
+
+    def __iter__(self):
+        d = {}
+        for m in reversed(self.maps):
+            d.update(dict.fromkeys(m))
+        return iter(d)
+
+    def __bool__(self):
+        return any(self.maps)
+
+    def __repr__(self):
+        return '{}({})'.format(type(self).__name__,', '.join(map(repr,self.maps)))
+
+    def pop(self,key,*default):
+        try:
+            return self.maps[0].pop(key,*default)
+        except KeyError:
+            raise KeyError('Key not found in the first mapping: {!r}'.format(key))
+
+    def popitem(self):
+        try:
+            return self.maps[0].popitem()
+        except KeyError:
+            raise KeyError('No keys found in the first mapping.')
+
+    def clear(self):
+        self.maps[0].clear()
+
+    def copy(self):
+        '''New chain with a copy of maps[0] and the same parents'''
+        return type(self)(self.maps[0].copy(),*self.maps[1:])
+
+    __copy__ = copy
+
+    def new_child(self,m=None):
+        return type(self)({} if m is None else m,*self.maps)
+
+    @property
+    def parents(self):
+        return type(self)(*self.maps[1:])
+
+
+scopes = LayeredMap({'x': 1})
+scopes = scopes.new_child()
+scopes['x'] = 2
+scopes.parents['x']         # 1
+scopes.maps[1]['y'] = 3     # seen through the child as well
+scopes['y']                 # 3
+
+
+def bench_layered_map(depths=(1,8,32,64),ratios=(1000,10,1),nops=2*10**5,nkeys=1000):
+    '''seconds per 10**6 operations, ChainMap vs LayeredMap, by depth and reads per write'''
+    rnd = random.Random(0)
+    for depth in depths:
+        for ratio in ratios:
+            layers = [{'k{}'.format(rnd.randrange(nkeys)): i for _ in range(nkeys//depth)}
+                      for i in range(depth)]
+            layers[-1] = {'k{}'.format(i): -1 for i in range(nkeys)}
+            ops = [('k{}'.format(rnd.randrange(nkeys + nkeys//10)),rnd.randrange(ratio + 1) == 0)
+                   for _ in range(nops)]
+            results = []
+            for cls in (ChainMap,LayeredMap):
+                chain = cls({},*[dict(m) for m in layers])
+                t0 = time.perf_counter()
+                got = []
+                append = got.append
+                for key,write in ops:
+                    if write:
+                        chain[key] = key
+                    else:
+                        append(chain.get(key))
+                results.append((time.perf_counter() - t0,got))
+            assert results[0][1] == results[1][1]
+            print('depth {:3d}  {:4d} reads/write  ChainMap {:.2f}s  LayeredMap {:.2f}s'.format(
+                  depth,ratio,results[0][0]*10**6/nops,results[1][0]*10**6/nops))
+
 '''
 merged = dict(b)
 merged.update(a)    # not gonna to change the merged dict
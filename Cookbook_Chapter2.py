@@ -18,6 +18,115 @@ re.split(r'[;,\s]\s*',line)
 re.split(r'(?:,|;|\s)\s*',line)
 re.split(r'([;,\s])\s*',line)
 
+'''
+re.split() needs the whole string in memory and returns the whole list. For big
+delimited feeds split_stream() reads a file (text or binary) or an iterable of
+chunks and yields the fields lazily, the same fields re.split() would give on
+the concatenated input. Each chunk goes through one C-level split. The last
+delimiter found may still grow into the next chunk (\s* may go on, ,(?:xyz)?
+may yet see its xyz), so it is carried over with the fields on either side and
+split again together with the next chunk. That is exact as long as whether and
+how far a delimiter matches never depends on text past the field that follows
+it (no lookahead beyond it), and the pattern never matches the empty string.
+With delimiters, a set of single characters (single bytes for binary input),
+the regex engine is not used at all: every delimiter is translated to the first
+one and str.split()/bytes.split() does the rest. Each delimiter then ends a
+field, like re.split('[;, ]') without the \s*.
+'''
+
+from functools import partial
+from itertools import chain
+
+def split_stream(source,pattern=r'[;,\s]\s*',delimiters=None,chunk_size=1<<20):
+    '''Yield the fields of source, a file or an iterable of str or bytes chunks'''
+    empty = ''
+    if isinstance(source,(str,bytes)):
+        source = [source]
+    elif hasattr(source,'read'):
+        empty = source.read(0)
+        source = iter(partial(source.read,chunk_size),empty)
+    chunks = iter(source)
+    first = next(chunks,None)
+    if first is None:
+        yield empty             # re.split(pattern,'') == ['']
+        return
+    chunks = chain([first],chunks)
+    binary = isinstance(first,bytes)
+    carry = first[:0]
+    if delimiters is not None:
+        if binary and isinstance(delimiters,str):
+            delimiters = delimiters.encode('latin-1')
+        elif not binary and not isinstance(delimiters,str):
+            raise TypeError('delimiters must be a str for text input')
+        sep = delimiters[:1]
+        table = (bytes.maketrans(delimiters,sep*len(delimiters)) if binary
+                 else str.maketrans(dict.fromkeys(delimiters,sep)))
+        for chunk in chunks:
+            fields = (carry + chunk).translate(table).split(sep)
+            carry = fields.pop()
+            yield from fields
+        yield carry
+        return
+    if binary and isinstance(pattern,str):
+        pattern = pattern.encode('latin-1')
+    elif not binary and not isinstance(pattern,str):
+        raise TypeError('pattern must be a str for text input')
+    # Capture the whole delimiter too, so the last one can be carried over
+    split = re.compile((b'(%s)' if binary else '(%s)') % pattern).split
+    step = split.__self__.groups + 1      # field, delimiter, the pattern's own groups
+    for chunk in chunks:
+        parts = split(carry + chunk)
+        if len(parts) > 1:
+            # field, delimiter, field: the delimiter may go on in the next chunk
+            carry = parts[-step-1] + parts[-step] + parts[-1]
+            del parts[-step-1:]
+        else:
+            carry = parts.pop()
+        del parts[1::step]
+        yield from parts
+    parts = split(carry)
+    del parts[1::step]
+    yield from parts
+
+list(split_stream(['asdf fjdk; af','ed, fjek,asdf, foo']))     # same as re.split(r'[;,\s]\s*',line)
+assert list(split_stream([',x','yz1'],pattern=r',(?:xyz)?')) == re.split(r',(?:xyz)?',',xyz1')
+assert list(split_stream([])) == re.split(r'[;,\s]\s*','') == ['']
+
+
+def bench_split_stream(mbytes=50,chunk_size=1<<20):
+    '''MB/s: re.split per line vs split_stream with the pattern vs with delimiters'''
+    import os
+    import random
+    import tempfile
+    import time
+    rnd = random.Random(0)
+    words = ['asdf','fjdk','afed','fjek','foo','x','123.45','ACME']
+    lines = []
+    size = 0
+    while size < mbytes * 10**6:
+        line = ''.join(rnd.choice(words) + rnd.choice(';, ') for _ in range(rnd.randrange(5,30)))[:-1] + '\n'
+        lines.append(line)
+        size += len(line)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp,'feed.txt')
+        with open(path,'w') as f:
+            f.writelines(lines)
+        nlines = len(lines)
+        del lines
+        t0 = time.perf_counter()
+        with open(path) as f:
+            per_line = sum(1 for line in f for field in re.split(r'[;,\s]\s*',line))
+        t1 = time.perf_counter()
+        with open(path) as f:
+            streamed = sum(1 for _ in split_stream(f,chunk_size=chunk_size))
+        t2 = time.perf_counter()
+        with open(path,'rb') as f:
+            fast = sum(1 for _ in split_stream(f,delimiters=b';, \n',chunk_size=chunk_size))
+        t3 = time.perf_counter()
+    assert per_line - nlines + 1 == streamed == fast     # re.split per line adds a '' after each \n
+    print('{:.0f} MB, {} fields: re.split per line {:.0f} MB/s  split_stream {:.0f} MB/s  delimiters {:.0f} MB/s'.format(
+          size/1e6,fast,size/1e6/(t1-t0),size/1e6/(t2-t1),size/1e6/(t3-t2)))
+
 
 
 # 2.2 Matching text at the start or end of the string
@@ -123,6 +232,160 @@ m.group(0)
 m.group(1)
 
 
+'''
+re.match(pattern, ...) and friends compile through re's own cache, which holds 512
+patterns and is dropped oldest-first when full, so a workload cycling through more
+patterns than that recompiles on every call. PatternRegistry mirrors the re
+functions on top of its own LRU of compiled patterns, keyed by (pattern, flags):
+    patterns.findall(r'\d+/\d+/\d+', text)
+It counts hits, misses, evictions and the seconds spent compiling. re has no
+serialized form of a compiled pattern, so what save() persists is the working set
+(pattern, flags, uses) as JSON; load() then compiles the most used ones up front,
+so the first calls after a restart hit instead of compiling on the request path.
+'''
+
+import json
+import time
+from collections import OrderedDict
+
+class PatternRegistry(object):
+    '''LRU of compiled patterns behind re's functions; save()/load() keep the working set'''
+    def __init__(self,maxsize=4096):
+        self.maxsize = maxsize
+        self._cache = OrderedDict()     # (pattern, flags) -> [compiled, uses]
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.compile_time = 0.0
+
+    def compile(self,pattern,flags=0):
+        if isinstance(pattern,re.Pattern):
+            return re.compile(pattern,flags)
+        key = (pattern,flags)
+        try:
+            entry = self._cache[key]
+            self._cache.move_to_end(key)
+        except KeyError:
+            self.misses += 1
+            t0 = time.perf_counter()
+            compiled = re.compile(pattern,flags)
+            self.compile_time += time.perf_counter() - t0
+            self._cache[key] = [compiled,1]
+            if len(self._cache) > self.maxsize:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+            return compiled
+        self.hits += 1
+        entry[1] += 1
+        return entry[0]
+
+    def match(self,pattern,string,flags=0):
+        return self.compile(pattern,flags).match(string)
+
+    def fullmatch(self,pattern,string,flags=0):
+        return self.compile(pattern,flags).fullmatch(string)
+
+    def search(self,pattern,string,flags=0):
+        return self.compile(pattern,flags).search(string)
+
+    def findall(self,pattern,string,flags=0):
+        return self.compile(pattern,flags).findall(string)
+
+    def finditer(self,pattern,string,flags=0):
+        return self.compile(pattern,flags).finditer(string)
+
+    def split(self,pattern,string,maxsplit=0,flags=0):
+        return self.compile(pattern,flags).split(string,maxsplit)
+
+    def sub(self,pattern,repl,string,count=0,flags=0):
+        return self.compile(pattern,flags).sub(repl,string,count)
+
+    def subn(self,pattern,repl,string,count=0,flags=0):
+        return self.compile(pattern,flags).subn(repl,string,count)
+
+    def warm(self,patterns):
+        '''Compile ahead of use; items are patterns or (pattern, flags)'''
+        for p in patterns:
+            pattern,flags = p if isinstance(p,tuple) else (p,0)
+            if (pattern,flags) not in self._cache:
+                self.compile(pattern,flags)
+
+    def stats(self):
+        calls = self.hits + self.misses
+        return {'size': len(self._cache),'hits': self.hits,'misses': self.misses,
+                'evictions': self.evictions,'compile_time': self.compile_time,
+                'hit_rate': self.hits / calls if calls else 0.0}
+
+    def save(self,path):
+        '''Write the cached (pattern, flags, uses), least recently used first'''
+        entries = [{'pattern': p.decode('latin-1') if isinstance(p,bytes) else p,
+                    'bytes': isinstance(p,bytes),'flags': int(flags),'uses': uses}
+                   for (p,flags),(_,uses) in self._cache.items()]
+        with open(path,'w') as f:
+            json.dump(entries,f)
+
+    def load(self,path):
+        '''Warm the cache from save(): the most used patterns that fit, with their uses'''
+        try:
+            with open(path) as f:
+                entries = json.load(f)
+        except FileNotFoundError:
+            return
+        # Least used first, so the most used end up most recently used; the sort is
+        # stable, so ties keep their saved LRU order
+        entries.sort(key=lambda e: e['uses'])
+        for e in entries[max(0,len(entries)-self.maxsize):]:
+            key = (e['pattern'].encode('latin-1') if e['bytes'] else e['pattern'],e['flags'])
+            if key not in self._cache:
+                self.compile(*key)
+                self._cache[key][1] = 0
+            self._cache[key][1] += e['uses']   # so the next save() ranks them as before
+
+
+# Warm-up at import with the patterns this chapter uses
+patterns = PatternRegistry()
+patterns.warm([r'[;,\s]\s*',r'\d+/\d+/\d+',r'(\d+)/(\d+)/(\d+)',('python',re.IGNORECASE),
+               r'\"(.*?)\"',r'/\*(.*?)\*/'])
+patterns.findall(r'\d+/\d+/\d+',text)
+patterns.stats()            # {'size': 6, 'hits': 1, 'misses': 6, ...}
+
+
+def bench_pattern_registry(npatterns=1000,ncalls=10**5,path=None):
+    '''re.* vs PatternRegistry, cycling through npatterns distinct patterns'''
+    import os
+    import random
+    import tempfile
+    rnd = random.Random(0)
+    pool = [r'(\d+)/(\d+)/(\d+)\s+{}(?:[a-z]+|[0-9]{{2,4}})\b'.format(w) for w in
+            ('tag{}'.format(i) for i in range(npatterns))]
+    calls = [rnd.choice(pool) for _ in range(ncalls)]
+    text = 'Today is 11/27/2012 tag7 abc. PyCon starts 3/13/2013 tag42 2013.'
+    re.purge()
+    t0 = time.perf_counter()
+    expected = [re.findall(p,text) for p in calls]
+    t1 = time.perf_counter()
+    registry = PatternRegistry()
+    got = [registry.findall(p,text) for p in calls]
+    t2 = time.perf_counter()
+    assert got == expected
+    print('{} calls over {} patterns: re.findall {:.2f}s  registry {:.2f}s  {}'.format(
+          ncalls,npatterns,t1-t0,t2-t1,registry.stats()))
+    with tempfile.TemporaryDirectory() as tmp:
+        path = path or os.path.join(tmp,'patterns.json')
+        registry.save(path)
+        t3 = time.perf_counter()
+        restarted = PatternRegistry()
+        restarted.load(path)
+        t4 = time.perf_counter()
+        [restarted.findall(p,text) for p in calls[:1000]]
+        t5 = time.perf_counter()
+        cold = PatternRegistry()
+        [cold.findall(p,text) for p in calls[:1000]]
+        t6 = time.perf_counter()
+    print('restart: load {:.3f}s, first 1000 calls warm {:.3f}s vs cold {:.3f}s'.format(
+          t4-t3,t5-t4,t6-t5))
+
+
 
 
 # 2.5 Searching and replacing text